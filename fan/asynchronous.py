@@ -9,13 +9,13 @@ import socket
 import time
 
 import aiohttp
-from basictracer import BasicTracer
 from basictracer.span import BasicSpan
-from py_zipkin.thrift import create_span, span_to_bytes, encode_bytes_list
+from py_zipkin.thrift import encode_bytes_list
 
 from fan.context import AsyncContext
 from fan.contrib.aio.discovery import LazyAiozkDiscovery
-from fan.sync import BaseFanRecorder
+from fan.sampling import get_sampler
+from fan.sync import BaseFanRecorder, BaseSpanExporter, FanTracer, encode_span
 from fan.transport import AsyncHTTPTransport, HTTPPropagator
 from fan.utils import async_cache
 
@@ -45,22 +45,101 @@ MY_IP = socket.gethostbyname(socket.gethostname())
 log = logging.getLogger('fan.async')
 
 
-async def async_zipkin_log_span(span_id, parent_span_id, trace_id, span_name, annotations,
-                                binary_annotations, timestamp_s, duration_s, **kwargs):
-    span = create_span(span_id, parent_span_id, trace_id, span_name, annotations,
-                       binary_annotations, timestamp_s, duration_s)
-    await async_http_transport(encode_bytes_list([span_to_bytes(span)]))
+async def async_zipkin_log_span(**kwargs):
+    await async_http_transport(encode_bytes_list([encode_span(**kwargs)]))
+
+
+class AsyncSpanExporter(BaseSpanExporter):
+    """
+    Sends spans from background task, so recording span costs only append to queue
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.task = None
+        self.wakeup = None
+        self.session = None
+        self.stopping = False
+
+    def ensure_started(self):
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            # task and session are bound to loop
+            self.loop = loop
+            self.task = self.session = None
+            self.wakeup = asyncio.Event()
+        if self.task is None or self.task.done():
+            self.stopping = False
+            self.task = asyncio.ensure_future(self.run())
+
+    def export(self, encoded_span):
+        self.ensure_started()
+        added = self._enqueue(encoded_span)
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+        return added
+
+    async def run(self):
+        while True:
+            if not self.stopping and len(self.queue) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+            batch = self._take_batch()
+            if batch:
+                await self.send(batch)
+            if self.stopping and not self.queue:
+                return
+
+    async def send(self, batch):
+        if self.session is None or self.session.closed:
+            timeout = aiohttp.ClientTimeout(total=ZIPKIN_TIMEOUT)
+            self.session = aiohttp.ClientSession(timeout=timeout)
+        try:
+            async with self.session.post(self.url, data=encode_bytes_list(batch),
+                                         headers=self.headers) as resp:
+                await resp.read()
+                resp.raise_for_status()
+            self.exported += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            log.warning('Failed to send {} spans to zipkin: {!r}'.format(len(batch), e))
+
+    async def stop(self):
+        """
+        Flush queued spans, stop background task and close session
+        """
+        if self.loop is not asyncio.get_event_loop():
+            return
+        if self.task and not self.task.done():
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+        self.task = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
 
 class AsyncFanRecorder(BaseFanRecorder):
+    def __init__(self, name, send_to_zipkin):
+        super().__init__(name, send_to_zipkin)
+        self.exporter = send_to_zipkin and AsyncSpanExporter(send_to_zipkin)
+
     async def record_span(self, span):
         if self.send_to_zipkin:
-            await async_zipkin_log_span(**self.zipkin_span_params(span))
+            self.exporter.export(encode_span(**self.zipkin_span_params(span)))
 
         log.info('Log span: {}'.format(self.log_span_params(span)))
 
         return super().record_span(span)
 
+    async def flush(self):
+        if self.send_to_zipkin:
+            await self.exporter.stop()
+
 
 class AsyncSpan(BasicSpan):
     async def finish(self, finish_time=None):
@@ -69,7 +148,7 @@ class AsyncSpan(BasicSpan):
         await self._tracer.record(self)
 
 
-class AsyncTracer(BasicTracer):
+class AsyncTracer(FanTracer):
     def start_span(self, operation_name=None, child_of=None, references=None, tags=None,
                    start_time=None):
         span = super().start_span(operation_name, child_of, references, tags, start_time)
@@ -77,7 +156,15 @@ class AsyncTracer(BasicTracer):
                          span.start_time)
 
     async def record(self, span):
-        await self.recorder.record_span(span)
+        if self.should_record(span):
+            await self.recorder.record_span(span)
+
+    async def flush(self):
+        """
+        Should be called on shutdown, to send spans that are still queued
+        """
+        if isinstance(self.recorder, AsyncFanRecorder):
+            await self.recorder.flush()
 
 
 def get_async_tracer(name=None):
@@ -86,7 +173,7 @@ def get_async_tracer(name=None):
         return tracer
 
     recorder = AsyncFanRecorder(name or 'no_name', send_to_zipkin=ZIPKIN)
-    tracer = AsyncTracer(recorder)
+    tracer = AsyncTracer(recorder, sampler=get_sampler())
     return tracer
 
 
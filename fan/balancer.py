@@ -0,0 +1,62 @@
+import itertools
+import random
+
+
+class Balancer:
+    '''
+    Chooses one of service instances for a call.
+    Instance is an endpoint with `outstanding` attribute: number of calls in progress
+    '''
+    def choose(self, instances):
+        raise NotImplementedError
+
+
+class RoundRobin(Balancer):
+    def __init__(self):
+        self.counter = itertools.count()
+
+    def choose(self, instances):
+        return instances[next(self.counter) % len(instances)]
+
+
+class Random(Balancer):
+    def choose(self, instances):
+        return random.choice(instances)
+
+
+class LeastOutstanding(Balancer):
+    def choose(self, instances):
+        least = min(i.outstanding for i in instances)
+        return random.choice([i for i in instances if i.outstanding == least])
+
+
+class PowerOfTwoChoices(Balancer):
+    '''
+    Almost as good as LeastOutstanding, but doesn't herd on a single instance
+    when outstanding counters are stale
+    '''
+    def choose(self, instances):
+        if len(instances) == 1:
+            return instances[0]
+        a, b = random.sample(instances, 2)
+        return a if a.outstanding <= b.outstanding else b
+
+
+BALANCERS = {
+    'round_robin': RoundRobin,
+    'random': Random,
+    'least_outstanding': LeastOutstanding,
+    'power_of_two': PowerOfTwoChoices,
+}
+
+
+def get_balancer(balancer):
+    '''
+    Accepts strategy name from BALANCERS, Balancer class or instance
+    '''
+    if isinstance(balancer, str):
+        balancer = BALANCERS[balancer]
+    if isinstance(balancer, type):
+        balancer = balancer()
+    assert isinstance(balancer, Balancer), balancer
+    return balancer
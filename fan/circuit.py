@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from fan.exceptions import AioRPCHttpError, CircuitOpenError, RPCHttpError, RPCTimeout
+
+
+def is_failure(error):
+    '''
+    Errors telling that instance is unhealthy: timeouts, connection problems and 5xx responses.
+    Other errors (like 4xx) are caller's problems
+    '''
+    if isinstance(error, RPCHttpError):
+        return error.response.status_code >= 500
+    if isinstance(error, AioRPCHttpError):
+        return error.status >= 500
+    return isinstance(error, (RPCTimeout, OSError, asyncio.TimeoutError, ConnectionError))
+
+
+class CircuitBreaker:
+    '''
+    Closed: calls pass, outcomes are kept in a window of last calls. When failed or slow
+    calls rate exceeds threshold, breaker opens and calls fail fast with CircuitOpenError.
+    After open_timeout breaker is half-open: a few trial calls decide to close or open it again
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window=20, min_calls=10, failure_rate=0.5, slow_call_duration=5,
+                 slow_call_rate=0.8, open_timeout=30, half_open_calls=1):
+        self.window = deque(maxlen=window)  # (failed, slow) of last calls
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.open_timeout = open_timeout
+        self.half_open_calls = half_open_calls
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.trials = 0
+        self.trial_successes = 0
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def stats(self):
+        return {'state': self.state, 'rejected': self.rejected, 'opened': self.opened}
+
+    @property
+    def available(self):
+        '''
+        whether call may be tried now, doesn't change state
+        '''
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.open_timeout
+        return self.trials < self.half_open_calls
+
+    def before_call(self):
+        '''
+        raises CircuitOpenError when call isn't allowed, returns start time for after_call
+        '''
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.open_timeout:
+                self.state = self.HALF_OPEN
+                self.trials = self.trial_successes = 0
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and
+                                           self.trials >= self.half_open_calls):
+                self.rejected += 1
+                raise CircuitOpenError('Circuit is {}'.format(self.state))
+            if self.state == self.HALF_OPEN:
+                self.trials += 1
+        return time.monotonic()
+
+    def after_call(self, started, error=None):
+        failed = error is not None and is_failure(error)
+        slow = time.monotonic() - started >= self.slow_call_duration
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if failed or slow:
+                    self._open()
+                else:
+                    self.trial_successes += 1
+                    if self.trial_successes >= self.half_open_calls:
+                        self.state = self.CLOSED
+                        self.window.clear()
+                return
+            self.window.append((failed, slow))
+            calls = len(self.window)
+            if self.state == self.CLOSED and calls >= self.min_calls:
+                failures = sum(f for f, _ in self.window)
+                slow_calls = sum(s for _, s in self.window)
+                if (failures >= calls * self.failure_rate or
+                        slow_calls >= calls * self.slow_call_rate):
+                    self._open()
+
+    def cancel_call(self):
+        '''
+        call was interrupted: it tells nothing about instance, trial slot is given back
+        '''
+        with self.lock:
+            if self.state == self.HALF_OPEN and self.trials > 0:
+                self.trials -= 1
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.opened += 1
+        self.window.clear()
+
+
+def get_breaker(config):
+    '''
+    Breaker from `circuit_breaker` endpoint param: True or dict of CircuitBreaker options
+    '''
+    if not config:
+        return None
+    if config is True:
+        return CircuitBreaker()
+    return CircuitBreaker(**config)
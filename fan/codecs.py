@@ -0,0 +1,167 @@
+import json
+import struct
+
+
+class Codec:
+    '''
+    Encodes transport messages to bytes and back
+    '''
+    name = None  # type: str
+    content_type = 'application/octet-stream'
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf8')
+
+    def decode(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf8')
+        return json.loads(data)
+
+
+class ORJSONCodec(JSONCodec):
+    '''
+    Non-str dict keys are converted like stdlib does, ints beyond 64 bits are encoded
+    by stdlib, but decoded as floats
+    '''
+    name = 'orjson'
+
+    def encode(self, obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return super().encode(obj)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class UJSONCodec(JSONCodec):
+    name = 'ujson'
+
+    def encode(self, obj):
+        try:
+            return ujson.dumps(obj).encode('utf8')
+        except (OverflowError, TypeError):
+            return super().encode(obj)
+
+    def decode(self, data):
+        return ujson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    '''
+    Binary and more compact than json, bytes values are passed as is
+    '''
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class RawCodec(Codec):
+    '''
+    Json envelope, bytes arguments and responses are passed through as is after it,
+    e.g. for relays of already encoded payloads. Bytes nested deeper aren't supported
+    '''
+    name = 'raw'
+    HEADER = struct.Struct('!I')  # length of json envelope
+
+    def encode(self, obj):
+        envelope, blobs, raw = dict(obj), [], []
+        for field in ('args', 'kwargs'):
+            if field not in envelope:
+                continue
+            values = envelope[field]
+            values = dict(values) if field == 'kwargs' else list(values)
+            keys = values if field == 'kwargs' else range(len(values))
+            for key in keys:
+                if isinstance(values[key], (bytes, bytearray)):
+                    blobs.append(values[key])
+                    raw.append([field, key, len(values[key])])
+                    values[key] = None
+            envelope[field] = values
+        if isinstance(envelope.get('response'), (bytes, bytearray)):
+            blobs.append(envelope['response'])
+            raw.append(['response', None, len(envelope['response'])])
+            envelope['response'] = None
+        if raw:
+            envelope['raw'] = raw
+        data = json.dumps(envelope).encode('utf8')
+        return b''.join([self.HEADER.pack(len(data)), data] + blobs)
+
+    def decode(self, data):
+        data = memoryview(data)
+        size, = self.HEADER.unpack(data[:self.HEADER.size])
+        offset = self.HEADER.size + size
+        msg = json.loads(bytes(data[self.HEADER.size:offset]).decode('utf8'))
+        for field, key, size in msg.pop('raw', ()):
+            value = bytes(data[offset:offset + size])
+            offset += size
+            if key is None:
+                msg[field] = value
+            else:
+                msg[field][key] = value
+        return msg
+
+
+CODECS = {
+    'json': JSONCodec(),
+    'raw': RawCodec(),
+}
+
+try:
+    import orjson
+    CODECS['orjson'] = ORJSONCodec()
+except ImportError:
+    pass
+
+try:
+    import ujson
+    CODECS['ujson'] = UJSONCodec()
+except ImportError:
+    pass
+
+try:
+    import msgpack
+    CODECS['msgpack'] = MsgpackCodec()
+except ImportError:
+    pass
+
+# the fastest installed json backend, its messages are read by stdlib json and vice versa
+CODECS['fast_json'] = CODECS.get('orjson') or CODECS.get('ujson') or CODECS['json']
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def choose_codec(names):
+    '''
+    The first installed codec of names given in preference order
+    '''
+    if isinstance(names, str):
+        names = [names]
+    for name in names:
+        if name in CODECS:
+            return name
+    raise ValueError('None of codecs {} is installed, available: {}'.format(
+        names, sorted(CODECS)))
+
+
+def get_codec(names='json'):
+    return CODECS[choose_codec(names)]
@@ -1,14 +1,30 @@
+import time
+
+from fan.exceptions import DeadlineExceeded
 from fan.rpc import RPC
 from fan.service import Service
 
 
+def deadline_expired(deadline):
+    """
+    Caller of incoming request has already given up waiting for the result,
+    transports skip such requests instead of handling them
+    """
+    return deadline is not None and deadline <= time.time()
+
+
 class Context:
-    def __init__(self, discovery, service=None, parent=None, name=None, baggage=None):
+    def __init__(self, discovery, service=None, parent=None, name=None, baggage=None,
+                 deadline=None):
         self.discovery = discovery
         if service:
             assert isinstance(service, Service), service
         self.service = service
         self.parent = parent
+        # absolute unix time when result isn't needed anymore, inherited by child contexts
+        if deadline is None and isinstance(parent, Context):
+            deadline = parent.deadline
+        self.deadline = deadline
 
         if isinstance(parent, Context):
             parent_context = parent.span.context
@@ -19,10 +35,33 @@ class Context:
             for k, v in baggage.items():
                 self.span.set_baggage_item(k, v)
         self._entered = False
+        self._rpc = None
 
     def create_child_context(self, name=None):
         return self.__class__(self.discovery, self.service, self, name)
 
+    def set_timeout(self, timeout):
+        '''
+        restrict deadline to `timeout` seconds from now, never extends inherited one
+        '''
+        deadline = time.time() + timeout
+        if self.deadline is None or deadline < self.deadline:
+            self.deadline = deadline
+
+    def time_left(self):
+        '''
+        seconds until deadline or None if there is no deadline
+        '''
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def check_deadline(self):
+        left = self.time_left()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded('Deadline exceeded {:.3f}s ago'.format(-left))
+        return left
+
     @property
     def rpc(self):
         '''
@@ -34,7 +73,9 @@ class Context:
         so you should not do that in services
         '''
         assert self._entered, 'You must enter context before call .rpc'
-        return RPC(self)
+        if self._rpc is None:
+            self._rpc = RPC(self)
+        return self._rpc
 
     def pre_call(self):
         pass
@@ -65,7 +106,9 @@ class AsyncContext(Context):
         so you should not do that in services
         """
         assert self._entered, 'You must enter context before call .rpc'
-        return RPC(self, async_caller=True)
+        if self._rpc is None:
+            self._rpc = RPC(self, async_caller=True)
+        return self._rpc
 
     async def pre_call(self):
         pass
@@ -84,4 +127,6 @@ class AsyncContext(Context):
         await self.post_call()
 
     async def stop(self):
+        await self.discovery.tracer.flush()
+        await self.discovery.close_http_session()
         await self.discovery.zk.session.close()
@@ -1,15 +1,23 @@
+import asyncio
+import functools
 import json
 import logging
+import time
 
 from aiozk import ZKClient, exc
 
-from fan.contrib.kazoo.discovery import VSN_RE
+from fan.contrib.kazoo.discovery import select_configs, select_version
 from fan.discovery import CompositeDiscovery, RemoteDiscovery
-from fan.contrib.aio.remote import AIOProxyEndpoint
+from fan.remote import host
+from fan.contrib.aio.remote import AIOBalancedProxyEndpoint, AIOProxyEndpoint
+from fan.transport import create_client_session
+from fan.utils import AsyncSingleFlight
 
 
 class ZKDiscovery(RemoteDiscovery):
     log = logging.getLogger('fan.aio.ZKDiscovery')
+    http_session_options = {}  # type: dict
+    balancer = 'round_robin'  # see fan.balancer.BALANCERS
 
     def __init__(self, zk_path, chroot='/', with_data_watcher=True, loop=None):
         super().__init__()
@@ -19,6 +27,7 @@ class ZKDiscovery(RemoteDiscovery):
         self.loop = loop
         self.check_zk_task = None
         self.zk = ZKClient(zk_path, chroot, loop=loop)
+        self.http_session = None
 
     async def create(self, path, **kwargs):
         try:
@@ -53,6 +62,7 @@ class ZKDiscovery(RemoteDiscovery):
         path = name.split('.')
         path.append(endpoint.version)
         barrier_path = '/'.join(path + ['barrier'])
+        host(endpoint)
         return await self.register_raw(path, endpoint.config, barrier_path)
 
     async def register_raw(self, path, data, barrier_path=None) -> tuple:
@@ -67,28 +77,39 @@ class ZKDiscovery(RemoteDiscovery):
 
         if not await self.zk.exists(path):
             return
-        childs = await self.zk.get_children(path)
-        if len(childs) == 0:
+        version = select_version(await self.zk.get_children(path))
+        if not version:
             return
 
-        childs = [x for x in childs if VSN_RE.match(x)]
-        version = sorted(childs)[-1]
         vpath = '{}/{}'.format(path, version)
-        configs = await self.zk.get_children(vpath)
-        # keep only config_ paths
-        configs = filter(lambda x: x.startswith('config_'), configs)
+        configs = select_configs(await self.zk.get_children(vpath))
         return await self.create_endpoint(service_name, vpath, configs)
 
+    async def get_config(self, path):
+        data = await self.zk.get_data(path)
+        self.log.debug('GET DATA: {!r}'.format(data))
+        return json.loads(data)
+
     async def create_endpoint(self, name, path, configs):
-        # TODO: pass all configs
-        configs = sorted(configs)
         assert len(configs), (name, path, configs)
-        config = configs[-1]
-        dpath = '{}/{}'.format(path, config)
-        data = await self.zk.get_data(dpath)
-        self.log.debug('GET DATA: {!r}'.format(data))
-        params = json.loads(data)
-        return AIOProxyEndpoint(self, name, params)
+        instances = {}
+        for config in configs:
+            dpath = '{}/{}'.format(path, config)
+            instances[dpath] = await self.get_config(dpath)
+        return AIOBalancedProxyEndpoint(self, name, instances, self.balancer)
+
+    def get_http_session(self):
+        """
+        http session shared between all AsyncHTTPTransport instances of discovery
+        """
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = create_client_session(**self.http_session_options)
+        return self.http_session
+
+    async def close_http_session(self):
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
 
     def watch(self, path, callback):
         self.data_watcher.add_callback(path, callback)
@@ -97,6 +118,8 @@ class ZKDiscovery(RemoteDiscovery):
         self.data_watcher.remove_callback(path, callback)
 
     def remove_all_wathers(self):
+        if not self.with_data_watcher:
+            return
         for path, callbacks in list(self.data_watcher.callbacks.items()):
             for callback in list(callbacks):
                 self.data_watcher.remove_callback(path, callback)
@@ -104,6 +127,7 @@ class ZKDiscovery(RemoteDiscovery):
     async def stop(self):
         self.closing = True
         self.remove_all_wathers()
+        await self.close_http_session()
         await self.zk.session.close()
 
 
@@ -123,14 +147,160 @@ def ensure_started(fn):
 
 
 class LazyAiozkDiscovery(ZKDiscovery):
+    """
+    Caches found endpoints. Zookeeper watches keep instances of cached endpoint up to date,
+    new service version drops endpoint from cache
+    """
+    drain_timeout = 10  # dropped endpoints are stopped when their calls finish or on timeout
+    drain_interval = 0.05  # how often calls in progress are checked
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.endpoints = {}
+        self.endpoint_watches = {}
+        self.lookups = AsyncSingleFlight()
+        self.generation = 0  # changed when cached endpoint is dropped, invalidates rpc stubs
+        self.stopping = set()  # tasks stopping dropped endpoints and instances
+
+    async def on_start(self):
+        await super().on_start()
+        self.children_watcher = self.zk.recipes.ChildrenWatcher()
+        self.children_watcher.set_client(self.zk)
+        self.config_watcher = self.zk.recipes.DataWatcher()
+        self.config_watcher.set_client(self.zk)
+
     @ensure_started
     async def find_endpoint(self, service_tuple, version_filter):
+        if service_tuple in self.endpoints:
+            return self.endpoints[service_tuple]
         service_name = '.'.join(service_tuple)
-        return await super().find_endpoint(service_name, version_filter)
+        # concurrent lookups of the same service share one endpoint and set of watches
+        lookup = functools.partial(super().find_endpoint, service_name, version_filter)
+        return await self.lookups.do(service_tuple, lookup)
 
     @ensure_started
-    async def create_endpoint(self, *args, **kwargs):
-        return await super().create_endpoint(*args, **kwargs)
+    async def create_endpoint(self, name, path, configs):
+        endpoint = await super().create_endpoint(name, path, configs)
+        service_tuple = tuple(name.split('.'))
+        self.invalidate(service_tuple)
+        self.endpoints[service_tuple] = endpoint
+        self.endpoint_watches[service_tuple] = {}
+        service_path, version = path.rsplit('/', 1)
+        self.add_watch(service_tuple, self.children_watcher, service_path,
+                       self.gen_versions_callback(service_tuple, version))
+        self.add_watch(service_tuple, self.children_watcher, path,
+                       self.gen_configs_callback(service_tuple, path))
+        self.watch_instances(service_tuple)
+        return endpoint
+
+    def add_watch(self, service_tuple, watcher, path, callback):
+        self.endpoint_watches[service_tuple][path] = (watcher, callback)
+        watcher.add_callback(path, callback)
+
+    def remove_watch(self, service_tuple, path):
+        watcher, callback = self.endpoint_watches[service_tuple].pop(path)
+        watcher.remove_callback(path, callback)
+
+    def watch_instances(self, service_tuple):
+        """
+        watch config data of every instance, stop watching removed ones
+        """
+        instances = self.endpoints[service_tuple].instances
+        watches = self.endpoint_watches[service_tuple]
+        for path, (watcher, _) in list(watches.items()):
+            if watcher is self.config_watcher and path not in instances:
+                self.remove_watch(service_tuple, path)
+        for path in instances:
+            if path not in watches:
+                self.add_watch(service_tuple, self.config_watcher, path,
+                               self.gen_config_callback(service_tuple, path))
+
+    def update_instances(self, service_tuple, instances):
+        endpoint = self.endpoints[service_tuple]
+        for instance in endpoint.update_instances(instances):
+            self.stop_later(instance)
+        self.watch_instances(service_tuple)
+
+    def gen_versions_callback(self, service_tuple, version):
+        def updated(childs):
+            if childs == exc.NoNode or select_version(childs) != version:
+                self.log.debug('New version of {}'.format(service_tuple))
+                self.invalidate(service_tuple)
+
+        return updated
+
+    def gen_configs_callback(self, service_tuple, path):
+        async def updated(childs):
+            endpoint = self.endpoints.get(service_tuple)
+            configs = [] if childs == exc.NoNode else select_configs(childs)
+            config_paths = ['{}/{}'.format(path, config) for config in configs]
+            if not endpoint or set(config_paths) == set(endpoint.instances):
+                return
+            if not config_paths:
+                self.invalidate(service_tuple)
+                return
+            instances = {}
+            for config_path in config_paths:
+                if config_path in endpoint.instances:
+                    instances[config_path] = endpoint.instances[config_path].params
+                    continue
+                try:
+                    instances[config_path] = await self.get_config(config_path)
+                except exc.NoNode:
+                    pass
+            # endpoint may be invalidated while we were fetching configs
+            if self.endpoints.get(service_tuple) is endpoint:
+                self.update_instances(service_tuple, instances)
+
+        return updated
+
+    def gen_config_callback(self, service_tuple, path):
+        def updated(data):
+            endpoint = self.endpoints.get(service_tuple)
+            instance = endpoint and endpoint.instances.get(path)
+            # removed instances are handled by configs watch
+            if not instance or data == exc.NoNode:
+                return
+            params = json.loads(data)
+            if params != instance.params:
+                instances = {k: v.params for k, v in endpoint.instances.items()}
+                instances[path] = params
+                self.update_instances(service_tuple, instances)
+
+        return updated
+
+    def invalidate(self, service_tuple):
+        for path, (watcher, callback) in self.endpoint_watches.pop(service_tuple, {}).items():
+            watcher.remove_callback(path, callback)
+        endpoint = self.endpoints.pop(service_tuple, None)
+        if endpoint:
+            self.generation += 1
+            self.stop_later(endpoint)
+
+    def stop_later(self, endpoint):
+        task = asyncio.ensure_future(self.drain(endpoint))
+        self.stopping.add(task)
+        task.add_done_callback(self.stopping.discard)
+
+    async def drain(self, endpoint):
+        """
+        stop dropped endpoint or instance when calls in progress are finished
+        """
+        instances = getattr(endpoint, 'instance_list', [endpoint])
+        deadline = time.time() + self.drain_timeout
+        while any(i.outstanding for i in instances) and time.time() < deadline:
+            await asyncio.sleep(self.drain_interval)
+        try:
+            await endpoint.on_stop()
+        except Exception:
+            self.log.exception('Stop of dropped endpoint {} failed'.format(endpoint.name))
+
+    async def stop(self):
+        for service_tuple in list(self.endpoints):
+            self.invalidate(service_tuple)
+        if self.stopping:
+            await asyncio.wait(list(self.stopping))
+        await super().stop()
 
     def get_transport_class(self, name):
         return self.transport_classes[name]
@@ -0,0 +1,166 @@
+import functools
+import inspect
+import json
+
+from aiohttp import web
+
+from fan.context import Context, deadline_expired
+from fan.contrib.aio.remote import run_in_context
+from fan.remote import RemoteEndpoint, Transport, unhost
+from fan.transport import HTTPPropagator
+
+
+def method_table(service, params):
+    """
+    Method configs for callers' AsyncHTTPTransport: POST route per rpc method of service
+    under `url_prefix` (/service/name by default). Configs given in params are merged in,
+    so they may change url, http method or add caching, retry and other policies
+    """
+    prefix = params.get('url_prefix', '/' + service.name.replace('.', '/'))
+    given = {method['name']: method for method in params.get('methods', [])}
+    methods = []
+    for name in sorted(service._rpc):
+        if name == '_meta':
+            continue
+        method = {'name': name,
+                  'url': '{}/{}'.format(prefix, name),
+                  'method': 'POST',
+                  'content_type': 'application/json'}
+        method.update(given.get(name, {}))
+        methods.append(method)
+    return methods
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+class HTTPServerTransport(Transport):
+    """
+    aiohttp server with a route per method of params. Request is dispatched into
+    handle_call within a context continuing caller's trace, generator results are
+    streamed as json array
+    """
+    context_class = Context  # AsyncContext for discovery with AsyncTracer of fan.asynchronous
+    stream_chunk_size = 64 * 1024  # streamed response is flushed in chunks of this size
+
+    def __init__(self, discovery, endpoint, params):
+        super().__init__(discovery, endpoint, params)
+        self.runner = None
+        self.rejected = 0
+
+    def create_app(self):
+        app = web.Application()
+        for method in self.params['methods']:
+            handler = functools.partial(self.handle_request, method['name'])
+            app.router.add_route(method.get('method', 'GET').upper(), method['url'], handler)
+        return app
+
+    async def on_start(self):
+        self.runner = web.AppRunner(self.create_app(), access_log=None)
+        await self.runner.setup()
+        host = self.params.get('bind', self.params['host'])
+        await web.TCPSite(self.runner, host, self.params['port']).start()
+        self.started = True
+
+    async def on_stop(self):
+        self.stopped = True
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def request_kwargs(self, request):
+        kwargs = dict(request.query)
+        if request.can_read_body:
+            body = await request.json()
+            if isinstance(body, dict):
+                kwargs.update(body)
+        kwargs.update(request.match_info)
+        return kwargs
+
+    async def handle_request(self, method_name, request):
+        deadline = HTTPPropagator.extract_deadline(request.headers)
+        if deadline_expired(deadline):
+            self.rejected += 1
+            return web.Response(status=504, text='Deadline exceeded')
+        try:
+            kwargs = await self.request_kwargs(request)
+        except ValueError as e:
+            return web.Response(status=400, text='Malformed request: {}'.format(e))
+        parent = self.discovery.tracer.extract('http', request.headers)
+        ctx = self.context_class(self.discovery, self.endpoint.service, parent, method_name,
+                                 deadline=deadline)
+        return await run_in_context(ctx, functools.partial(
+            self.respond, request, ctx, method_name, kwargs))
+
+    async def respond(self, request, ctx, method_name, kwargs):
+        result = self.handle_call(method_name, ctx, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        if inspect.isgenerator(result) or inspect.isasyncgen(result):
+            return await self.stream(request, result)
+        return web.Response(body=json.dumps(result).encode('utf8'),
+                            content_type='application/json')
+
+    async def stream(self, request, items):
+        if inspect.isgenerator(items):
+            items = iterate(items)
+        items = items.__aiter__()
+        # the first item is taken before status is sent, so early errors get 500
+        try:
+            chunk = json.dumps(await items.__anext__()).encode('utf8')
+        except StopAsyncIteration:
+            return web.Response(body=b'[]', content_type='application/json')
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        buffer, size = [b'[', chunk], len(chunk) + 1
+        try:
+            async for item in items:
+                chunk = json.dumps(item).encode('utf8')
+                buffer.append(b',' + chunk)
+                size += len(chunk) + 1
+                if size >= self.stream_chunk_size:
+                    await response.write(b''.join(buffer))
+                    buffer, size = [], 0
+        except Exception:
+            # 200 is sent already: drop connection without the last chunk,
+            # so caller can't take truncated array for the whole result
+            request.transport.close()
+            raise
+        buffer.append(b']')
+        await response.write(b''.join(buffer))
+        await response.write_eof()
+        return response
+
+
+class HTTPEndpoint(RemoteEndpoint):
+    """
+    Serves service over http without hand written routes. Generated method table
+    is a part of params, so discovery registers it for callers
+    """
+    transport_class = HTTPServerTransport
+
+    def __init__(self, discovery, service, params):
+        params = dict(params, methods=method_table(service, params))
+        params.pop('url_prefix', None)
+        self.service = service
+        self.params = params
+        self.remote_params = params
+        self.transport = self.transport_class(discovery, self, params)
+
+    @property
+    def config(self):
+        return self.remote_params
+
+    @property
+    def version(self):
+        return self.params.get('version', '1.0.0')
+
+    async def on_start(self):
+        await self.transport.on_start()
+
+    async def on_stop(self):
+        unhost(self)
+        await self.transport.on_stop()
@@ -1,27 +1,125 @@
 import asyncio
+import functools
+import heapq
+import inspect
+import time
 from types import CoroutineType
 
 from basictracer.context import SpanContext
 
-from fan.context import Context
-from fan.remote import ProxyEndpoint, Transport, RemoteEndpoint
+from fan.codecs import CODECS, choose_codec
+from fan.context import AsyncContext, Context, deadline_expired
+from fan.exceptions import DeadlineExceeded, RemoteError, RPCTimeout
+from fan.hedging import LatencyTracker, get_hedge_budget, hedge_policies
+from fan.limiter import AsyncConcurrencyLimiter
+from fan.remote import (BalancedProxyEndpoint, ProxyEndpoint, Transport, RemoteEndpoint,
+                        is_idempotent)
+from fan.utils import AsyncSingleFlight
+
+
+class PendingCalls:
+    """
+    Futures of calls waiting for response. Deadlines are kept in a heap served
+    by a single timer scheduled for the nearest one
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.futures = {}
+        self.deadlines = []
+        self.timer = None
+        self.timer_at = None
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.futures)
+
+    @property
+    def stats(self):
+        return {'pending': len(self.futures), 'expired': self.expired}
+
+    def add(self, key, timeout):
+        assert key not in self.futures, 'Duplicate call: {}'.format(key)
+        f = self.futures[key] = self.loop.create_future()
+        deadline = self.loop.time() + timeout
+        heapq.heappush(self.deadlines, (deadline, key))
+        if self.timer_at is None or deadline < self.timer_at:
+            self.schedule(deadline)
+        return f
+
+    def discard(self, key):
+        # deadline stays in heap and is skipped on expiration
+        self.futures.pop(key, None)
+        if not self.futures:
+            self.deadlines.clear()
+            self.schedule(None)
+        elif len(self.deadlines) > 2 * len(self.futures) + 64:
+            self.deadlines = [d for d in self.deadlines if d[1] in self.futures]
+            heapq.heapify(self.deadlines)
+
+    def resolve(self, key, result):
+        f = self.futures.pop(key, None)
+        if f is None or f.done():
+            return False
+        f.set_result(result)
+        return True
+
+    def fail_all(self, reason):
+        futures, self.futures = self.futures, {}
+        for f in futures.values():
+            if not f.done():
+                f.set_exception(reason)
+        self.deadlines.clear()
+        self.schedule(None)
+
+    def schedule(self, deadline):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.timer_at = deadline
+        if deadline is not None:
+            self.timer = self.loop.call_at(deadline, self.expire)
+
+    def expire(self):
+        self.timer = self.timer_at = None
+        now = self.loop.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, key = heapq.heappop(self.deadlines)
+            f = self.futures.pop(key, None)
+            if f is not None and not f.done():
+                self.expired += 1
+                f.set_exception(RPCTimeout(key))
+        if self.deadlines:
+            self.schedule(self.deadlines[0][0])
 
 
 class AIOTransport(Transport):
+    max_in_flight = 100  # requests handled concurrently by remote endpoint
+    drain_timeout = 10  # wait for requests in progress on stop
+    call_timeout = 60  # fail call if there is no response in time
+    codec = 'json'  # message codec or list of codecs in preference order, see fan.codecs
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.loop = asyncio.get_event_loop()
         self.remote = isinstance(self.endpoint, RemoteEndpoint)
-        self.responses = {}
+        codec = choose_codec(self.get_param('codec'))
+        if self.remote and 'codec' in self.params:
+            # registered config tells callers which of the codecs this instance has chosen,
+            # given params are left intact
+            self.params = dict(self.params, codec=codec)
+            self.endpoint.remote_params = self.params
+        self.message_codec = CODECS[codec]
+        self.pending = PendingCalls(self.loop)
+        self.in_flight = set()
+        self.semaphore = asyncio.Semaphore(self.get_param('max_in_flight'))
+        self.rejected = 0
 
-    def terminate(self, reason):
-        for v in self.responses.values():
-            v.set_exception(reason)
+    @property
+    def stats(self):
+        return dict(self.pending.stats, in_flight=len(self.in_flight), rejected=self.rejected)
 
-    async def wait_or_terminate(self, coro):
-        f = asyncio.ensure_future(coro)
-        ret = await asyncio.wait([f, self.terminate_future], return_when=asyncio.FIRST_COMPLETED)
-        return await ret[0].pop()
+    def terminate(self, reason):
+        self.pending.fail_all(reason)
 
     async def rpc_call(self, name, ctx, *args, **kwargs):
         # span_id, trace_id, sampled, baggage, with_baggage_item
@@ -30,39 +128,40 @@ class AIOTransport(Transport):
         context_headers = {'span_id': c.span_id,
                            'trace_id': c.trace_id,
                            'sampled': c.sampled}
+        timeout = self.get_param('call_timeout')
+        time_left = ctx.check_deadline()
+        if time_left is not None:
+            context_headers['deadline'] = ctx.deadline
+            timeout = min(timeout, time_left)
         self.log.debug('CTX: {}'.format(context_headers))
         msg = {'context_headers': context_headers,
                'method': name,
                'args': args,
                'kwargs': kwargs}
-        f = self.responses[str(c.span_id)] = asyncio.Future()
-        resp = await self.rpc_inner_call(msg, f)
+        key = str(c.span_id)
+        f = self.pending.add(key, timeout)
+        try:
+            resp = await self.rpc_inner_call(msg, f)
+        except RPCTimeout as e:
+            if ctx.deadline is None or ctx.time_left() > 0:
+                raise
+            raise DeadlineExceeded(name) from e
+        finally:
+            self.pending.discard(key)
+        if 'error' in resp:
+            raise RemoteError('{} failed: {}'.format(name, resp['error']))
         return resp['response']
 
     async def read_loop(self, *args, **kwargs):
         try:
             while not self.stopped:
+                if self.remote:
+                    # don't take new message until there is a free slot
+                    await self.semaphore.acquire()
                 msg = await self.inner_read_message(*args, **kwargs)
                 assert type(msg) == dict, 'Msg is: {!r}'.format(msg)
-                ctx_headers = msg['context_headers']
                 if self.remote:
-                    parent_ctx = SpanContext(**ctx_headers)
-                    method = msg['method']
-                    ctx = Context(self.discovery, self.endpoint.service,
-                                  parent_ctx, method)
-                    self.log.debug('CTX: {}'.format(ctx.span.context.trace_id))
-                    call_args = msg.get('args', ())
-                    call_kwargs = msg.get('kwargs', {})
-                    hc = self.handle_call(method, ctx, *call_args, **call_kwargs)
-                    if isinstance(hc, CoroutineType):
-                        resp = await hc
-                    else:
-                        resp = hc
-                    self.log.debug('Remote send resp ==> {}'.format(resp))
-                    response = {'context_headers': msg['context_headers'],
-                                'method': msg['method'],
-                                'response': resp}
-                    await self.remote_send_response(msg, response)
+                    self.track(self.dispatch(msg))
                 else:
                     self.log.debug('Proxy return resp: {}'.format(msg))
                     self.proxy_send_response(msg)
@@ -72,6 +171,55 @@ class AIOTransport(Transport):
             self.log.exception('In read loop')
             self.terminate(e)
 
+    def track(self, coro):
+        """
+        run request handling in background, drain waits for it on stop
+        """
+        task = asyncio.ensure_future(coro)
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+        return task
+
+    async def dispatch(self, msg):
+        try:
+            await self.handle_message(msg)
+        except Exception:
+            self.log.exception('During handling: {}'.format(msg.get('method')))
+        finally:
+            self.semaphore.release()
+
+    async def handle_message(self, msg):
+        ctx_headers = dict(msg['context_headers'])
+        deadline = ctx_headers.pop('deadline', None)
+        method = msg['method']
+        if deadline_expired(deadline):
+            self.rejected += 1
+            self.log.warning('Skip expired call: {}'.format(method))
+            return
+        parent_ctx = SpanContext(**ctx_headers)
+        ctx = Context(self.discovery, self.endpoint.service, parent_ctx, method, deadline=deadline)
+        self.log.debug('CTX: {}'.format(ctx.span.context.trace_id))
+        call_args = msg.get('args', ())
+        call_kwargs = msg.get('kwargs', {})
+        hc = self.handle_call(method, ctx, *call_args, **call_kwargs)
+        if isinstance(hc, CoroutineType):
+            resp = await hc
+        else:
+            resp = hc
+        self.log.debug('Remote send resp ==> {}'.format(resp))
+        response = {'context_headers': msg['context_headers'],
+                    'method': msg['method'],
+                    'response': resp}
+        await self.remote_send_response(msg, response)
+
+    async def drain(self):
+        """
+        wait until requests in progress are answered, should be called after reading stopped
+        """
+        if self.in_flight:
+            self.log.debug('Drain {} requests'.format(len(self.in_flight)))
+            await asyncio.wait(list(self.in_flight), timeout=self.get_param('drain_timeout'))
+
     async def remote_send_response(self, request, response):
         raise NotImplementedError
 
@@ -80,7 +228,8 @@ class AIOTransport(Transport):
 
     def proxy_send_response(self, msg):
         span_id = str(msg['context_headers']['span_id'])
-        self.responses.pop(span_id).set_result(msg)
+        if not self.pending.resolve(span_id, msg):
+            self.log.warning('Response to unknown or expired call: {}'.format(span_id))
 
     async def rpc_inner_call(msg, future):
         """
@@ -102,10 +251,14 @@ class AIOQueueBasedTransport:
     async def on_start(self):
         await self.sub_prepare()
         await self.pub_prepare()
+        self.started = True
 
     async def on_stop(self):
-        await self.pub_stop()
+        # stop taking new requests, but keep publisher to answer ones in progress
+        self.stopped = True
         await self.sub_stop()
+        await self.drain()
+        await self.pub_stop()
 
     def sub_prepare(self):
         raise NotImplementedError
@@ -120,15 +273,178 @@ class AIOQueueBasedTransport:
         raise NotImplementedError
 
 
+async def run_in_context(ctx, coro_fn):
+    """
+    await coro_fn() within sync or async context
+    """
+    if isinstance(ctx, AsyncContext):
+        async with ctx:
+            return await coro_fn()
+    with ctx:
+        return await coro_fn()
+
+
 class AIOProxyEndpoint(ProxyEndpoint):
+    single_flight_class = AsyncSingleFlight
+    limiter_class = AsyncConcurrencyLimiter
 
     async def perform_call(self, ctx, method_name, *args, **kwargs):
+        key = self.coalesce_key(method_name, args, kwargs)
+        call = functools.partial(self.call_with_retries, ctx, method_name, *args, **kwargs)
+        if self.limiter:
+            call = functools.partial(self.limiter.run, call)
+        if key is None:
+            return await call()
+        if key in self.flights:
+            ctx.span.set_tag('coalesced', True)
+        return await self.flights.do(key, call)
+
+    async def call_with_retries(self, ctx, method_name, *args, **kwargs):
+        policy = self.policies['retry'].get(method_name)
+        if policy is None:
+            return await self.call(ctx, method_name, *args, **kwargs)
+        self.retry_budget.on_request()
+        tried = []
+        attempt = 1
+        while True:
+            try:
+                if attempt == 1:
+                    return await self.attempt(ctx, tried, method_name, args, kwargs)
+                retry_ctx = ctx.create_child_context(name='retry {}'.format(attempt))
+                retry_ctx.span.set_tag('retry', attempt)
+                return await run_in_context(retry_ctx, functools.partial(
+                    self.attempt, retry_ctx, tried, method_name, args, kwargs))
+            except Exception as e:
+                attempt += 1
+                delay = self.retry_delay(ctx, policy, attempt, e)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def attempt(self, ctx, tried, method_name, args, kwargs):
+        return await self.call(ctx, method_name, *args, **kwargs)
+
+    async def rpc_call(self, method_name, ctx, *args, **kwargs):
+        local = self.find_local()
+        if local is not None:
+            ctx.check_deadline()
+            # service methods may be sync or async
+            result = local.perform_call(ctx, method_name, *args, **kwargs)
+            if isinstance(result, CoroutineType):
+                result = await result
+            # transports return streamed results as lists, in-process call does the same
+            if inspect.isasyncgen(result):
+                result = [item async for item in result]
+            elif inspect.isgenerator(result):
+                result = list(result)
+            return result
         if not self.transport.started:
             await self.transport.on_start()
         return await self.transport.rpc_call(method_name, ctx, *args, **kwargs)
 
+    async def call(self, ctx, method_name, *args, **kwargs):
+        if self.breaker is None:
+            return await self.rpc_call(method_name, ctx, *args, **kwargs)
+        started = self.breaker.before_call()
+        try:
+            result = await self.rpc_call(method_name, ctx, *args, **kwargs)
+        except asyncio.CancelledError:
+            # e.g. lost hedge, it's an Exception on python 3.6
+            self.breaker.cancel_call()
+            raise
+        except Exception as e:
+            self.breaker.after_call(started, e)
+            raise
+        except BaseException:
+            self.breaker.cancel_call()
+            raise
+        self.breaker.after_call(started)
+        return result
+
     async def on_start(self):
         await self.transport.on_start()
 
     async def on_stop(self):
         await self.transport.on_stop()
+
+
+class AIOBalancedProxyEndpoint(BalancedProxyEndpoint):
+    instance_class = AIOProxyEndpoint
+    single_flight_class = AsyncSingleFlight
+    limiter_class = AsyncConcurrencyLimiter
+    perform_call = AIOProxyEndpoint.perform_call
+    call_with_retries = AIOProxyEndpoint.call_with_retries
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hedge_budget = get_hedge_budget(self.params or {})
+        self.latency = {}  # method name => LatencyTracker of hedged methods
+        self.hedged = 0
+
+    def method_policies(self, params):
+        policies = super().method_policies(params)
+        policies['hedge'] = hedge_policies(params, is_idempotent)
+        return policies
+
+    async def call(self, ctx, method_name, *args, **kwargs):
+        return await self.attempt(ctx, [], method_name, args, kwargs)
+
+    async def attempt(self, ctx, tried, method_name, args, kwargs):
+        policy = self.policies['hedge'].get(method_name)
+        if policy is None or len(self.instance_list) < 2:
+            return await self.instance_attempt(ctx, tried, method_name, args, kwargs)
+        return await self.hedged_attempt(policy, ctx, tried, method_name, args, kwargs)
+
+    async def hedged_attempt(self, policy, ctx, tried, method_name, args, kwargs):
+        """
+        When the first instance doesn't answer in time, ask another one too.
+        First successful response wins, the other request is cancelled
+        """
+        latency = self.latency.setdefault(method_name, LatencyTracker())
+        self.hedge_budget.on_request()
+
+        async def timed_attempt(attempt_ctx):
+            started = time.monotonic()
+            result = await self.instance_attempt(attempt_ctx, tried, method_name, args, kwargs)
+            latency.add(time.monotonic() - started)
+            return result
+
+        first = asyncio.ensure_future(timed_attempt(ctx))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=policy.get_delay(latency))
+            if done or not self.hedge_budget.withdraw():
+                return await first
+            self.hedged += 1
+            hedge_ctx = ctx.create_child_context(name='hedge')
+            hedge_ctx.span.set_tag('hedge', True)
+            tasks.add(asyncio.ensure_future(
+                run_in_context(hedge_ctx, functools.partial(timed_attempt, hedge_ctx))))
+            while True:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.exception():
+                        return task.result()
+                if not tasks:
+                    # both failed
+                    return done.pop().result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def instance_attempt(self, ctx, tried, method_name, args, kwargs):
+        instance = self.choose_instance(tried, self.shard(method_name, args, kwargs))
+        tried.append(instance)
+        instance.outstanding += 1
+        try:
+            return await instance.call(ctx, method_name, *args, **kwargs)
+        finally:
+            instance.outstanding -= 1
+
+    async def on_start(self):
+        for instance in self.instance_list:
+            await instance.on_start()
+
+    async def on_stop(self):
+        for instance in self.instance_list:
+            await instance.on_stop()
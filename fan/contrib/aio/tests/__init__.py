@@ -58,6 +58,10 @@ class DummyService(Service):
         self.log.debug('Call ping endpoint {}'.format(ctx.span.context.trace_id))
         return 'pong'
 
+    @endpoint
+    def echo(self, ctx, data):
+        return data
+
 
 class AIOEndpointCase(AIOTestCase):
     endpoint_class = AIODummyEndpoint
@@ -101,6 +105,8 @@ class AIOEndpointCase(AIOTestCase):
         self.ctx_local.append(ld)
         discovery = AIOCompositeDiscovery(self.get_local_discovery(),
                                           self.dict_discovery)
+        # calls have to go through the transport under test
+        discovery.short_circuit = False
         discovery.tracer = BasicTracer(self.recorder)
         return Context(discovery, self.svc)
 
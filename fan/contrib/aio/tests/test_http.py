@@ -0,0 +1,106 @@
+import asyncio
+
+import aiohttp
+import pytest
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.context import Context
+from fan.contrib.aio.http import HTTPEndpoint
+from fan.contrib.aio.remote import AIOProxyEndpoint
+from fan.discovery import CompositeDiscovery, LocalDiscovery, SimpleDictDiscovery
+from fan.exceptions import AioRPCHttpError
+from fan.service import Service, endpoint
+from fan.transport import AsyncHTTPTransport, HTTPPropagator
+
+
+class HTTPDiscovery(LocalDiscovery):
+    def get_transport_class(self, name):
+        return AsyncHTTPTransport
+
+
+class ItemsService(Service):
+    name = 'shop.items'
+
+    @endpoint
+    def get(self, ctx, item_id):
+        return {'id': int(item_id), 'trace_id': ctx.span.context.trace_id}
+
+    @endpoint
+    async def count(self, ctx, items):
+        await asyncio.sleep(0)
+        return len(items)
+
+    @endpoint
+    def range(self, ctx, size):
+        return (i for i in range(size))
+
+    @endpoint
+    def fail(self, ctx):
+        raise ValueError('broken')
+
+    @endpoint
+    def broken_range(self, ctx, size):
+        for i in range(size):
+            if i == size - 1:
+                raise ValueError('broken')
+            yield i
+
+
+@pytest.fixture
+def discovery():
+    discovery = CompositeDiscovery(HTTPDiscovery(), SimpleDictDiscovery({}))
+    discovery.tracer = BasicTracer(InMemoryRecorder())
+    discovery.tracer.register_propagator('http', HTTPPropagator())
+    # calls have to go through http
+    discovery.short_circuit = False
+    return discovery
+
+
+@pytest.mark.asyncio
+async def test_serve(discovery):
+    methods = [{'name': 'get', 'url': '/items/{item_id}/', 'method': 'GET'}]
+    remote = HTTPEndpoint(discovery, ItemsService(),
+                          {'transport': 'http', 'host': '127.0.0.1', 'port': 18766,
+                           'methods': methods})
+    await remote.on_start()
+    discovery.register(remote)
+    config = discovery.remote.data['shop']['items']
+    assert [m['name'] for m in config['methods']] == ['broken_range', 'count', 'fail', 'get',
+                                                      'range']
+    assert config['methods'][1]['url'] == '/shop/items/count'
+
+    proxy = AIOProxyEndpoint(discovery, ('shop', 'items'), config)
+    with Context(discovery) as ctx:
+        result = await proxy.perform_call(ctx, 'get', item_id=5)
+        assert result == {'id': 5, 'trace_id': ctx.span.context.trace_id}
+        assert await proxy.perform_call(ctx, 'count', items=[1, 2, 3]) == 3
+        remote.transport.stream_chunk_size = 4
+        assert await proxy.perform_call(ctx, 'range', size=5) == [0, 1, 2, 3, 4]
+        with pytest.raises(AioRPCHttpError):
+            await proxy.perform_call(ctx, 'fail')
+    await proxy.transport.on_stop()
+    await remote.on_stop()
+
+
+@pytest.mark.asyncio
+async def test_errors(discovery):
+    remote = HTTPEndpoint(discovery, ItemsService(),
+                          {'transport': 'http', 'host': '127.0.0.1', 'port': 18766})
+    await remote.on_start()
+    discovery.register(remote)
+    proxy = AIOProxyEndpoint(discovery, ('shop', 'items'), discovery.remote.data['shop']['items'])
+    async with aiohttp.ClientSession() as session:
+        async with session.post('http://127.0.0.1:18766/shop/items/count',
+                                data=b'{"items": [1,') as resp:
+            assert resp.status == 400
+    with Context(discovery) as ctx:
+        # nothing is sent yet
+        with pytest.raises(AioRPCHttpError):
+            await proxy.perform_call(ctx, 'broken_range', size=1)
+        # response is broken instead of a truncated array
+        remote.transport.stream_chunk_size = 1
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await proxy.perform_call(ctx, 'broken_range', size=5)
+    await proxy.transport.on_stop()
+    await remote.on_stop()
@@ -0,0 +1,275 @@
+import asyncio
+
+import pytest
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.context import Context
+from fan.contrib.aio.remote import (AIOBalancedProxyEndpoint, AIOProxyEndpoint, AIOQueueBasedTransport,
+                                    AIOTransport)
+from fan.discovery import LocalDiscovery
+from fan.exceptions import ConcurrencyLimitExceeded, DeadlineExceeded, RemoteError, RPCTimeout
+from fan.remote import RemoteEndpoint, host
+from fan.service import Service, endpoint
+
+
+class QueueTransport(AIOQueueBasedTransport, AIOTransport):
+    """
+    In-memory queues instead of a broker
+    """
+    queues = {}  # type: dict
+
+    async def sub_prepare(self):
+        if self.remote:
+            self.queue = self.queues[self.params['queue']] = asyncio.Queue()
+        else:
+            self.queue = asyncio.Queue()
+        self._read = asyncio.ensure_future(self.read_loop())
+
+    async def pub_prepare(self):
+        pass
+
+    async def sub_stop(self):
+        self._read.cancel()
+
+    async def pub_stop(self):
+        pass
+
+    async def inner_read_message(self):
+        return await self.queue.get()
+
+    async def rpc_inner_call(self, msg, future):
+        msg['back_route'] = self.queue
+        await self.queues[self.params['queue']].put(msg)
+        return await future
+
+    async def remote_send_response(self, msg, response):
+        await msg['back_route'].put(response)
+
+
+class QueueEndpoint(RemoteEndpoint):
+    async def on_start(self):
+        await self.transport.on_start()
+
+    async def on_stop(self):
+        await self.transport.on_stop()
+
+
+class QueueDiscovery(LocalDiscovery):
+    def get_transport_class(self, name):
+        return QueueTransport
+
+
+class SlowService(Service):
+    name = 'slow'
+
+    def __init__(self):
+        super().__init__()
+        self.running = 0
+        self.max_running = 0
+
+    @endpoint
+    async def sleep(self, ctx, delay):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(delay)
+        self.running -= 1
+        return delay
+
+    @endpoint
+    def count(self, ctx, n):
+        yield from range(n)
+
+    @endpoint
+    async def stream(self, ctx, n):
+        for i in range(n):
+            yield i
+
+
+@pytest.fixture
+def discovery():
+    discovery = QueueDiscovery()
+    discovery.tracer = BasicTracer(InMemoryRecorder())
+    return discovery
+
+
+async def start_pair(discovery, **params):
+    params = dict({'transport': 'queue', 'queue': 'slow'}, **params)
+    service = SlowService()
+    remote = QueueEndpoint(discovery, service, params)
+    await remote.on_start()
+    proxy = AIOProxyEndpoint(discovery, ('slow',), params)
+    await proxy.on_start()
+    return service, remote, proxy
+
+
+async def call(discovery, proxy, *args, timeout=None):
+    with Context(discovery) as ctx:
+        if timeout is not None:
+            ctx.set_timeout(timeout)
+        return await proxy.perform_call(ctx, 'sleep', *args)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_dispatch(discovery):
+    service, remote, proxy = await start_pair(discovery, max_in_flight=2)
+    calls = [call(discovery, proxy, 0.05) for _ in range(4)]
+    assert await asyncio.gather(*calls) == [0.05] * 4
+    assert service.max_running == 2
+    await proxy.on_stop()
+    await remote.on_stop()
+
+
+@pytest.mark.asyncio
+async def test_drain_on_stop(discovery):
+    service, remote, proxy = await start_pair(discovery)
+    result = asyncio.ensure_future(call(discovery, proxy, 0.05))
+    await asyncio.sleep(0.01)
+    await remote.on_stop()
+    assert service.running == 0
+    assert await result == 0.05
+    await proxy.on_stop()
+
+
+@pytest.mark.asyncio
+async def test_call_timeout(discovery):
+    service, remote, proxy = await start_pair(discovery, call_timeout=0.02)
+    with pytest.raises(RPCTimeout):
+        await call(discovery, proxy, 0.05)
+    assert proxy.transport.stats['pending'] == 0
+    assert proxy.transport.stats['expired'] == 1
+    # late response is dropped, next call still works
+    await asyncio.sleep(0.05)
+    assert await call(discovery, proxy, 0) == 0
+    await proxy.on_stop()
+    await remote.on_stop()
+
+
+@pytest.mark.asyncio
+async def test_deadline(discovery):
+    service, remote, proxy = await start_pair(discovery)
+    with pytest.raises(DeadlineExceeded):
+        await call(discovery, proxy, 0.05, timeout=0.02)
+    assert await call(discovery, proxy, 0, timeout=1) == 0
+    # expired calls are not handled
+    with pytest.raises(DeadlineExceeded):
+        await call(discovery, proxy, 0, timeout=-1)
+    msg = {'context_headers': {'span_id': 1, 'trace_id': 1, 'sampled': True, 'deadline': 0},
+           'method': 'sleep', 'args': [0]}
+    await remote.transport.handle_message(msg)
+    assert remote.transport.stats['rejected'] == 1
+    await proxy.on_stop()
+    await remote.on_stop()
+
+
+@pytest.mark.asyncio
+async def test_coalesce(discovery):
+    methods = [{'name': 'sleep', 'idempotent': True}]
+    service, remote, proxy = await start_pair(discovery, coalesce=True, methods=methods)
+    calls = [call(discovery, proxy, 0.02) for _ in range(3)] + [call(discovery, proxy, 0.01)]
+    assert await asyncio.gather(*calls) == [0.02] * 3 + [0.01]
+    assert service.max_running == 2
+    assert proxy.flights.coalesced == 2
+    await proxy.on_stop()
+    await remote.on_stop()
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit(discovery):
+    limit = {'initial_limit': 2, 'max_limit': 2, 'max_queue': 1}
+    service, remote, proxy = await start_pair(discovery, concurrency_limit=limit)
+    calls = [asyncio.ensure_future(call(discovery, proxy, 0.02)) for _ in range(4)]
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    assert results[:3] == [0.02] * 3
+    assert isinstance(results[3], ConcurrencyLimitExceeded)
+    assert service.max_running == 2
+    assert proxy.limiter.stats == {'limit': 2, 'in_flight': 0, 'queued': 0, 'rejected': 1}
+    await proxy.on_stop()
+    await remote.on_stop()
+
+
+class FlakyTransport(AIOTransport):
+    async def on_start(self):
+        self.started = True
+
+    async def rpc_call(self, name, ctx, *args, **kwargs):
+        if self.params['id'] == 0:
+            raise RPCTimeout()
+        return self.params['id']
+
+
+@pytest.mark.asyncio
+async def test_retry(discovery):
+    discovery.get_transport_class = lambda name: FlakyTransport
+    configs = {'i{}'.format(i): {'transport': 'flaky', 'id': i,
+                                 'retry': {'methods': ['get'], 'backoff': 0}} for i in range(2)}
+    endpoint = AIOBalancedProxyEndpoint(discovery, 'svc', configs)
+    for _ in range(2):
+        with Context(discovery) as ctx:
+            assert await endpoint.perform_call(ctx, 'get') == 1
+    with Context(discovery) as ctx:
+        with pytest.raises(RPCTimeout):
+            await endpoint.perform_call(ctx, 'post')
+
+
+class LaggingTransport(AIOTransport):
+    async def on_start(self):
+        self.started = True
+
+    async def rpc_call(self, name, ctx, *args, **kwargs):
+        try:
+            await asyncio.sleep(self.params['delay'])
+        except asyncio.CancelledError:
+            self.endpoint.cancelled = True
+            raise
+        return self.params['id']
+
+
+@pytest.mark.asyncio
+async def test_hedge(discovery):
+    discovery.get_transport_class = lambda name: LaggingTransport
+    configs = {'i0': {'transport': 'lag', 'id': 0, 'delay': 1},
+               'i1': {'transport': 'lag', 'id': 1, 'delay': 0}}
+    for config in configs.values():
+        config['hedge'] = {'methods': ['get'], 'delay': 0.01, 'budget': {'ratio': 1}}
+    endpoint = AIOBalancedProxyEndpoint(discovery, 'svc', configs)
+    with Context(discovery) as ctx:
+        assert await endpoint.perform_call(ctx, 'get') == 1
+    assert endpoint.hedged == 1
+    await asyncio.sleep(0)
+    assert endpoint.instances['i0'].cancelled
+    names = [s.operation_name for s in discovery.tracer.recorder.get_spans()]
+    assert 'hedge' in names
+
+
+@pytest.mark.asyncio
+async def test_short_circuit(discovery):
+    params = {'transport': 'queue', 'queue': 'hosted'}
+    service = SlowService()
+    remote = QueueEndpoint(discovery, service, params)
+    host(remote)
+    endpoint = AIOBalancedProxyEndpoint(discovery, 'slow', {'i0': params})
+    # transport is never started, the call goes straight to the service
+    with Context(discovery) as ctx:
+        assert await endpoint.perform_call(ctx, 'sleep', 0) == 0
+        # streamed results are lists, as if they came through the transport
+        assert await endpoint.perform_call(ctx, 'count', 2) == [0, 1]
+        assert await endpoint.perform_call(ctx, 'stream', 2) == [0, 1]
+    assert service.max_running == 1
+    assert not endpoint.instances['i0'].transport.started
+    assert not remote.transport.started
+
+
+@pytest.mark.asyncio
+async def test_remote_error(discovery):
+    requests = QueueTransport.queues['failing'] = asyncio.Queue()
+    proxy = AIOProxyEndpoint(discovery, ('slow',), {'transport': 'queue', 'queue': 'failing'})
+    await proxy.on_start()
+    with Context(discovery) as ctx:
+        call = asyncio.ensure_future(proxy.perform_call(ctx, 'sleep', 0))
+        msg = await requests.get()
+        await msg['back_route'].put({'context_headers': msg['context_headers'],
+                                     'method': msg['method'], 'error': "ValueError('broken')"})
+        with pytest.raises(RemoteError):
+            await call
+    await proxy.on_stop()
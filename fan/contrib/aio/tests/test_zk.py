@@ -3,7 +3,8 @@ import os
 
 from tipsi_tools.testing.aio import AIOTestCase
 
-from fan.contrib.aio.discovery import ZKDiscovery
+from fan.contrib.aio.discovery import LazyAiozkDiscovery, ZKDiscovery
+from fan.transport import AsyncHTTPTransport
 from fan.tests import TEST_TIMEOUT
 
 
@@ -47,3 +48,46 @@ class TestZK(AIOTestCase):
             pass
         await barrier.lift()
         await self.remote.register(ep)
+
+
+class TestLazyDiscovery(AIOTestCase):
+    config = {'transport': 'http', 'host': '127.0.0.1', 'port': 80, 'methods': []}
+    path = ['/endpoints', 'test_lazy', '1.0.0']
+
+    async def setUp(self):
+        zk_host = os.environ.get('ZK_HOST', 'zk:2181')
+        self.remote = ZKDiscovery(zk_host, chroot='/test_fan')
+        await asyncio.wait_for(self.remote.on_start(), TEST_TIMEOUT)
+        self.discovery = LazyAiozkDiscovery(zk_host, chroot='/test_fan', with_data_watcher=False)
+        self.discovery.transport_classes = {'http': AsyncHTTPTransport}
+
+    async def tearDown(self):
+        await self.discovery.stop()
+        await self.remote.zk.deleteall('/endpoints/test_lazy')
+        await self.remote.stop()
+
+    async def test_endpoint_cache(self):
+        await self.remote.register_raw(self.path, self.config)
+        ep = await self.discovery.find_endpoint(('test_lazy',), None)
+        self.assertIs(ep, await self.discovery.find_endpoint(('test_lazy',), None))
+
+        await self.remote.register_raw(self.path, dict(self.config, port=81))
+        await asyncio.sleep(0.2)  # wait for watch notification
+        self.assertIs(ep, await self.discovery.find_endpoint(('test_lazy',), None))
+        self.assertEqual([i.params['port'] for i in ep.instance_list], [80, 81])
+
+        await self.remote.register_raw(['/endpoints', 'test_lazy', '2.0.0'], self.config)
+        await asyncio.sleep(0.2)
+        self.assertIsNot(ep, await self.discovery.find_endpoint(('test_lazy',), None))
+
+    async def test_drain(self):
+        await self.remote.register_raw(self.path, self.config)
+        ep = await self.discovery.find_endpoint(('test_lazy',), None)
+        instance = ep.instance_list[0]
+        instance.outstanding = 1  # call in progress
+        self.discovery.invalidate(('test_lazy',))
+        await asyncio.sleep(0.2)
+        self.assertFalse(instance.transport.stopped)
+        instance.outstanding = 0
+        await asyncio.wait(list(self.discovery.stopping))
+        self.assertTrue(instance.transport.stopped)
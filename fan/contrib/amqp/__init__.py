@@ -6,8 +6,8 @@ from types import CoroutineType
 
 from basictracer.context import SpanContext
 
-from fan.context import Context
-from fan.remote import RemoteEndpoint
+from fan.context import Context, deadline_expired
+from fan.remote import RemoteEndpoint, unhost
 from fan.contrib.aio.remote import AIOTransport, AIOQueueBasedTransport
 
 
@@ -39,6 +39,8 @@ class AMQPTransport(AIOQueueBasedTransport, AIOTransport):
                                                         params.get('exchange_type', 'direct'))
         self.log.debug('Subscribe...')
         if self.remote:
+            # broker doesn't deliver more unacked messages than we handle concurrently
+            await self.sub.set_qos(prefetch_count=self.get_param('max_in_flight'))
             queue_name = params['queue']
             queue = await self.sub.declare_queue(queue_name)
             await queue.bind(self.exchange, self.routing_key)
@@ -47,17 +49,19 @@ class AMQPTransport(AIOQueueBasedTransport, AIOTransport):
             queue = await self.sub.declare_queue(queue_name, nowait=True)
         # self.loop.create_task(self.read_loop(queue))
         self.queue = queue
-        await queue.consume(self.deliver, no_ack=not self.remote)
+        self.consumer = await queue.consume(self.deliver, no_ack=not self.remote)
 
     async def pub_prepare(self):
         self.pub = await self.conn.open_channel()
 
     async def sub_stop(self):
-        await self.sub.close()
-        await self.conn.close()
+        # channel stays open: requests in progress are acked and answered through it
+        await self.consumer.cancel()
 
     async def pub_stop(self):
+        await self.sub.close()
         await self.pub.close()
+        await self.conn.close()
 
     async def on_start(self):
         self.log.info('Start amqp')
@@ -69,8 +73,9 @@ class AMQPTransport(AIOQueueBasedTransport, AIOTransport):
             ctx[k] = str(v)
         body = msg
         span_id = str(ctx['span_id'])
-        amqp_msg = asynqp.Message(body,
+        amqp_msg = asynqp.Message(self.message_codec.encode(body),
                                   headers=ctx,
+                                  content_type=self.message_codec.content_type,
                                   reply_to='amq.rabbitmq.reply-to',
                                   correlation_id=span_id)
         self.log.debug('Publish message: {} {}'.format(self.exchange, self.routing_key))
@@ -80,36 +85,58 @@ class AMQPTransport(AIOQueueBasedTransport, AIOTransport):
 
     def deliver(self, msg):
         self.log.debug('DELIVERED: {}'.format(msg))
-        self.loop.create_task(self.read_loop(msg))
+        self.track(self.read_loop(msg))
 
     async def read_loop(self, raw_msg):
+        self.log.debug('Got message: {} Q[{}]'.format(raw_msg, self.queue.name))
+        if not self.remote:
+            try:
+                self.proxy_send_response(self.message_codec.decode(raw_msg.body))
+            except Exception as e:
+                self.terminate(e)
+            return
+        msg = None
         try:
-            self.log.debug('Got message: {} Q[{}]'.format(raw_msg, self.queue.name))
-            msg = raw_msg.json()
-            ctx_headers = msg['context_headers']
-            if self.remote:
-                parent_ctx = SpanContext(**ctx_headers)
-                method = msg['method']
-                ctx = Context(self.discovery, self.endpoint.service, parent_ctx, method)
-                self.log.debug('CTX: {} {}'.format(ctx.span.context.trace_id, raw_msg.correlation_id))
-                args = msg.get('args', ())
-                kwargs = msg.get('kwargs', {})
-                hc = self.handle_call(method, ctx, *args, **kwargs)
-                if isinstance(hc, CoroutineType):
-                    resp = await hc
-                else:
-                    resp = hc
-                self.log.debug('Send resp ==> : {}'.format(resp))
-                resp = asynqp.Message({'context_headers': msg['context_headers'],
-                                       'method': msg['method'],
-                                       'response': resp},
-                                      correlation_id=raw_msg.correlation_id)
-                self.default_exchange.publish(resp, raw_msg.reply_to, mandatory=False)
-                raw_msg.ack()
+            msg = self.message_codec.decode(raw_msg.body)
+            ctx_headers = dict(msg['context_headers'])
+            deadline = ctx_headers.pop('deadline', None)
+            deadline = deadline and float(deadline)
+            method = msg['method']
+            if deadline_expired(deadline):
+                self.rejected += 1
+                self.log.warning('Skip expired call: {}'.format(method))
+                return
+            # headers are sent as strings
+            ctx_headers['sampled'] = ctx_headers.get('sampled') in ('True', True)
+            parent_ctx = SpanContext(**ctx_headers)
+            ctx = Context(self.discovery, self.endpoint.service, parent_ctx, method,
+                          deadline=deadline)
+            self.log.debug('CTX: {} {}'.format(ctx.span.context.trace_id, raw_msg.correlation_id))
+            args = msg.get('args', ())
+            kwargs = msg.get('kwargs', {})
+            hc = self.handle_call(method, ctx, *args, **kwargs)
+            if isinstance(hc, CoroutineType):
+                resp = await hc
             else:
-                self.proxy_send_response(msg)
+                resp = hc
+            self.log.debug('Send resp ==> : {}'.format(resp))
+            self.reply(raw_msg, msg, response=resp)
         except Exception as e:
-            self.terminate(e)
+            # failed request shouldn't affect others handled concurrently
+            self.log.exception('During handling: {}'.format(raw_msg))
+            if isinstance(msg, dict) and 'context_headers' in msg:
+                # caller gets the error at once instead of waiting for call_timeout
+                self.reply(raw_msg, msg, error=repr(e))
+        finally:
+            # unacked messages hold prefetch slots, broker stops delivering when all are taken
+            raw_msg.ack()
+
+    def reply(self, raw_msg, msg, **result):
+        reply = dict(result, context_headers=msg['context_headers'], method=msg['method'])
+        resp = asynqp.Message(self.message_codec.encode(reply),
+                              content_type=self.message_codec.content_type,
+                              correlation_id=raw_msg.correlation_id)
+        self.default_exchange.publish(resp, raw_msg.reply_to, mandatory=False)
 
 
 class AMQPEndpoint(RemoteEndpoint):
@@ -117,4 +144,5 @@ class AMQPEndpoint(RemoteEndpoint):
         await self.transport.on_start()
 
     async def on_stop(self):
+        unhost(self)
         await self.transport.on_stop()
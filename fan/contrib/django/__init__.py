@@ -3,9 +3,10 @@ import logging
 from django.conf import settings
 from django.http import HttpResponse
 
-from fan.context import Context
+from fan.context import Context, deadline_expired
 from fan.exceptions import RPCHttpError
 from fan.sync import get_discovery
+from fan.transport import DjangoPropagator
 
 VARS = {}
 
@@ -44,16 +45,19 @@ class FanMiddleware(object):
         tracer = discovery.tracer
 
         span_context = tracer.extract('http', request.META)
+        deadline = DjangoPropagator.extract_deadline(request.META)
+        if deadline_expired(deadline):
+            return HttpResponse('Deadline exceeded', status=504)
         name = '{} {}'.format(request.method, request.path)
         if span_context:
-            ctx = Context(discovery, None, span_context, name)
+            ctx = Context(discovery, None, span_context, name, deadline=deadline)
         else:
             # TODO: should be configurable
             baggage = {}
             for k in ['HTTP_INSTALLATION_ID', 'HTTP_SESSION_ID']:
                 if k in request.META:
                     baggage[k.strip('HTTP_')] = request.META[k]
-            ctx = Context(discovery, None, None, name, baggage)
+            ctx = Context(discovery, None, None, name, baggage, deadline)
         request.ctx = ctx
         with ctx:
             update_vars(ctx, request)
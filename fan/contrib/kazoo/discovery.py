@@ -5,7 +5,7 @@ import re
 from kazoo.client import KazooClient
 
 from fan.discovery import RemoteDiscovery
-from fan.remote import ProxyEndpoint
+from fan.remote import BalancedProxyEndpoint
 
 
 VSN_RE = re.compile(r'^\d+(\.\d+){,2}$')
@@ -44,47 +44,82 @@ class KazooWrapper:
         return getattr(self.zk, name)
 
 
+def select_version(childs):
+    childs = [x for x in childs if VSN_RE.match(x)]
+    if childs:
+        return sorted(childs)[-1]
+
+
+def select_configs(childs):
+    # keep only config_ paths
+    return sorted(x for x in childs if x.startswith('config_'))
+
+
 class KazooDiscovery(RemoteDiscovery):
     log = logging.getLogger('KazooDiscovery')
     timeout = 5
+    balancer = 'round_robin'  # see fan.balancer.BALANCERS
 
     def __init__(self, zk_path, chroot='/'):
         super().__init__()
         self.zk = KazooWrapper(chroot=chroot, hosts=zk_path, timeout=self.timeout)
+        # keep endpoints (and their connection pools) while instance configs are the same
+        self.endpoints = {}
+        self.generation = 0  # changed by watches of found services, invalidates rpc stubs
 
     def on_start(self):
         self.zk.start(timeout=self.timeout)
 
     def on_stop(self):
+        for endpoint in self.endpoints.values():
+            endpoint.on_stop()
+        self.endpoints.clear()
+        self.generation += 1
         self.zk.stop()
 
+    def changed(self, event):
+        """
+        zookeeper watch: version or instances of a found service changed,
+        callers have to find it again
+        """
+        self.generation += 1
+
     def find_endpoint(self, service_tuple, version_filter):
         path = ['/endpoints'] + list(service_tuple)
         path = '/'.join(path)
 
         if not self.zk.exists(path):
             return
-        childs = self.zk.get_children(path)
+        # watches are one-shot, every lookup sets them again
+        childs = self.zk.get_children(path, watch=self.changed)
         if len(childs) == 0:
             return
-        childs = [x for x in childs if VSN_RE.match(x)]
-        version = sorted(childs)[-1]
+        version = select_version(childs)
         vpath = '{}/{}'.format(path, version)
-        configs = self.zk.get_children(vpath)
-        # keep only config_ paths
-        configs = filter(lambda x: x.startswith('config_'), configs)
+        configs = select_configs(self.zk.get_children(vpath, watch=self.changed))
         return self.create_endpoint(service_tuple, vpath, configs)
 
     def get_transport_class(self, name):
         return self.transport_classes[name]
 
     def create_endpoint(self, name, path, configs):
-        # TODO: pass all configs
-        configs = sorted(configs)
         assert len(configs), (name, path, configs)
-        config = configs[-1]
-        dpath = '{}/{}'.format(path, config)
-        data = self.zk.get(dpath)[0].decode('utf8')
-        self.log.debug('GET DATA: {!r}'.format(data))
-        params = json.loads(data)
-        return ProxyEndpoint(self, name, params)
+        endpoint = self.endpoints.get(name)
+        known = endpoint.instances if endpoint else {}
+        instances = {}
+        for config in configs:
+            dpath = '{}/{}'.format(path, config)
+            # config nodes are ephemeral, registration change creates a new one
+            if dpath in known:
+                instances[dpath] = known[dpath].params
+                continue
+            data = self.zk.get(dpath)[0].decode('utf8')
+            self.log.debug('GET DATA: {!r}'.format(data))
+            instances[dpath] = json.loads(data)
+        if endpoint:
+            for instance in endpoint.update_instances(instances):
+                instance.on_stop()
+        else:
+            endpoint = BalancedProxyEndpoint(self, name, instances, self.balancer)
+            self.endpoints[name] = endpoint
+        return endpoint
@@ -2,7 +2,7 @@ import asyncio
 import uuid
 import aioredis
 
-from fan.remote import RemoteEndpoint
+from fan.remote import RemoteEndpoint, unhost
 from fan.contrib.aio.remote import AIOTransport, AIOQueueBasedTransport
 
 
@@ -11,10 +11,37 @@ class RedisStop(Exception):
 
 
 class RedisTransport(AIOQueueBasedTransport, AIOTransport):
+    """
+    mode 'pubsub': every subscribed instance gets every request
+    mode 'list': work queue, each request is taken by exactly one instance:
+        proxy LPUSHes requests to `queue` list, remote moves them to own processing
+        list with BRPOPLPUSH and removes when answered. Requests of instances
+        without heartbeat are returned to the queue by alive ones.
+    Responses are always published to proxy's back route channel.
+    """
+    mode = 'pubsub'  # or 'list'
+    batch_size = 10  # max requests taken from list at once
+    heartbeat_interval = 5  # seconds between heartbeats and dead instances checks
+    heartbeat_ttl = 15  # instance is considered dead when heartbeat is older
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         import logging
         self.log = logging.getLogger(str(self))
+        self.work_queue = self.get_param('mode') == 'list'
+        self.consumer = str(uuid.uuid4())
+        self.buffer = []
+
+    @property
+    def processing_key(self):
+        return self.consumer_key(self.consumer, 'processing')
+
+    def consumer_key(self, consumer, kind):
+        return '{}:{}:{}'.format(self.params['queue'], kind, consumer)
+
+    @property
+    def consumers_key(self):
+        return '{}:consumers'.format(self.params['queue'])
 
     def new_connection(self):
         params = self.params
@@ -24,6 +51,13 @@ class RedisTransport(AIOQueueBasedTransport, AIOTransport):
 
     async def sub_prepare(self):
         self.sub = await self.new_connection()
+        if self.remote and self.work_queue:
+            self.log.debug('Consume {} as {}'.format(self.params['queue'], self.consumer))
+            self.pub = await self.new_connection()
+            await self.heartbeat()
+            self._heartbeat = asyncio.ensure_future(self.heartbeat_loop())
+            self._read = asyncio.ensure_future(self.read_loop())
+            return
         self.log.debug('Subscribe...')
         if self.remote:
             route = self.params['queue']
@@ -34,37 +68,104 @@ class RedisTransport(AIOQueueBasedTransport, AIOTransport):
         self._read = asyncio.ensure_future(self.read_loop(res[0]))
 
     async def pub_prepare(self):
-        self.pub = await self.new_connection()
+        if not (self.remote and self.work_queue):
+            self.pub = await self.new_connection()
 
     async def sub_stop(self):
+        self._read.cancel()
         self.sub.close()
 
     async def pub_stop(self):
-        self._read.cancel()
+        if self.remote and self.work_queue:
+            self._heartbeat.cancel()
+            # return taken but not handled requests to other instances
+            await self.requeue(self.consumer)
+            self.buffer = []
         self.pub.close()
         self.terminate(RedisStop())
 
+    async def heartbeat(self):
+        await self.pub.set(self.consumer_key(self.consumer, 'heartbeat'), 1,
+                           expire=self.get_param('heartbeat_ttl'))
+        await self.pub.sadd(self.consumers_key, self.consumer)
+
+    async def heartbeat_loop(self):
+        while not self.stopped:
+            try:
+                await asyncio.sleep(self.get_param('heartbeat_interval'))
+                await self.heartbeat()
+                await self.redeliver()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                self.log.exception('In heartbeat loop')
+
+    async def redeliver(self):
+        """
+        return requests stuck in processing lists of dead instances
+        """
+        consumers = await self.pub.smembers(self.consumers_key, encoding='utf-8')
+        for consumer in consumers:
+            if consumer == self.consumer:
+                continue
+            if not await self.pub.exists(self.consumer_key(consumer, 'heartbeat')):
+                count = await self.requeue(consumer)
+                self.log.info('Redeliver {} requests of dead instance {}'.format(count, consumer))
+
+    async def requeue(self, consumer):
+        # RPOPLPUSH is atomic, so every request is moved once even if several instances do it
+        count = 0
+        processing = self.consumer_key(consumer, 'processing')
+        while await self.pub.rpoplpush(processing, self.params['queue']):
+            count += 1
+        await self.pub.srem(self.consumers_key, consumer)
+        return count
+
     async def on_start(self):
         self.log.debug('Start redis')
         await super().on_start()
 
     async def rpc_inner_call(self, msg, resp):
         msg['back_route'] = self.back_route
-        is_ok = await self.pub.publish_json(self.params['queue'], msg)
+        if self.work_queue:
+            await self.pub.lpush(self.params['queue'], self.message_codec.encode(msg))
+            return await resp
+        is_ok = await self.pub.publish(self.params['queue'], self.message_codec.encode(msg))
         # TODO: not clear what this code actually mean
         assert is_ok in (1, 2, 3), 'Not ok: {} => {}'.format(is_ok, self.endpoint)
-        rep = await resp
-        return rep['response']
-
-    async def inner_read_message(self, chan):
-        await chan.wait_message()
-        return await chan.get_json()
+        return await resp
+
+    async def inner_read_message(self, chan=None):
+        if chan is not None:
+            await chan.wait_message()
+            return self.message_codec.decode(await chan.get())
+        if not self.buffer:
+            await self.read_batch()
+        raw = self.buffer.pop(0)
+        msg = self.message_codec.decode(raw)
+        msg['delivery'] = raw
+        return msg
+
+    async def read_batch(self):
+        queue, processing = self.params['queue'], self.processing_key
+        raw = await self.sub.brpoplpush(queue, processing)
+        self.buffer.append(raw)
+        tr = self.sub.pipeline()
+        more = [tr.rpoplpush(queue, processing) for _ in range(self.get_param('batch_size') - 1)]
+        await tr.execute()
+        self.buffer.extend(m.result() for m in more if m.result() is not None)
+
+    async def dispatch(self, msg):
+        try:
+            await super().dispatch(msg)
+        finally:
+            if 'delivery' in msg:
+                # ack: failed request is not retried, as with pubsub mode
+                await self.pub.lrem(self.processing_key, 1, msg['delivery'])
 
     async def remote_send_response(self, msg, response):
-        await self.pub.publish_json(msg['back_route'],
-                                    {'context_headers': msg['context_headers'],
-                                     'method': msg['method'],
-                                     'response': response})
+        # response is a complete reply already, codecs see the result at its top level
+        await self.pub.publish(msg['back_route'], self.message_codec.encode(response))
 
 
 class RedisEndpoint(RemoteEndpoint):
@@ -73,4 +174,5 @@ class RedisEndpoint(RemoteEndpoint):
         await self.transport.on_start()
 
     async def on_stop(self):
+        unhost(self)
         await self.transport.on_stop()
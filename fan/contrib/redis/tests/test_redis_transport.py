@@ -1,7 +1,9 @@
+import asyncio
 import os
 
 from fan.contrib.redis import RedisEndpoint, RedisTransport
 from fan.contrib.aio.tests import AIOEndpointCase
+from fan.tests import TEST_TIMEOUT
 
 
 class RedisCase(AIOEndpointCase):
@@ -17,3 +19,43 @@ class RedisCase(AIOEndpointCase):
 
     async def test_remote_register(self):
         await self._test_remote_register()
+
+
+class RedisListCase(RedisCase):
+    endpoint_params = dict(RedisCase.endpoint_params, queue='test_list', mode='list')
+
+    async def test_redeliver(self):
+        ep = self.endpoint_class(self.discovery, self.svc, self.endpoint_params)
+        await ep.on_start()
+        transport = ep.transport
+        listener = await transport.new_connection()
+        channel, = await listener.subscribe('test_redeliver_back')
+        request = {'context_headers': {'trace_id': 1, 'span_id': 2, 'sampled': False},
+                   'method': 'ping', 'args': [], 'kwargs': {},
+                   'back_route': 'test_redeliver_back'}
+        dead = transport.consumer_key('dead', 'processing')
+        await transport.pub.sadd(transport.consumers_key, 'dead')
+        await transport.pub.lpush(dead, transport.message_codec.encode(request))
+        await transport.redeliver()
+        self.assertEqual(await transport.pub.llen(dead), 0)
+        self.assertNotIn('dead', await transport.pub.smembers(transport.consumers_key,
+                                                               encoding='utf-8'))
+        # alive instance takes the request from the queue and answers it
+        await asyncio.wait_for(channel.wait_message(), TEST_TIMEOUT)
+        reply = transport.message_codec.decode(await channel.get())
+        self.assertEqual(reply['context_headers'], request['context_headers'])
+        self.assertEqual(reply['response'], 'pong')
+        listener.close()
+        await ep.on_stop()
+
+
+class RedisRawCase(RedisCase):
+    endpoint_params = dict(RedisCase.endpoint_params, queue='test_raw', codec='raw')
+
+    async def test_raw(self):
+        ep = self.endpoint_class(self.discovery, self.svc, self.endpoint_params)
+        await asyncio.wait_for(ep.on_start(), TEST_TIMEOUT)
+        self.discovery.register(ep)
+        with self.ctx as ctx:
+            res = await asyncio.wait_for(ctx.rpc.dummy.echo(b'\x00raw'), TEST_TIMEOUT)
+        self.assertEqual(res, b'\x00raw')
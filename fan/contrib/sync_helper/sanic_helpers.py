@@ -6,9 +6,12 @@ import os
 from typing import Type
 
 from sanic import Sanic
+from sanic.response import text
 
 from fan.asynchronous import get_discovery, AsyncContext
+from fan.context import deadline_expired
 from fan.contrib.sync_helper import SyncHelper
+from fan.transport import HTTPPropagator
 
 
 class SanicRegister:
@@ -37,13 +40,19 @@ class SanicRegister:
         }
         self.methods = []
 
-    def add(self, name, url, method='GET', content_type='application/json'):
-        self.service['methods'].append({
+    def add(self, name, url, method='GET', content_type='application/json', cache=None):
+        """
+        cache: optional client side caching policy, see docs/sync_config.md
+        """
+        config = {
             'name': name,
             'method': method,
             'url': url,
             'content_type': content_type,
-        })
+        }
+        if cache:
+            config['cache'] = cache
+        self.service['methods'].append(config)
 
     async def register(self, app=None, loop=None):
         assert app or loop, 'Either app nor loop must be provided as keyword argument'
@@ -95,6 +104,7 @@ class SanicServiceHelper:
         self._host = host
         self._port = port
         self.sanic_server = None
+        self.discovery = None
         self.app = Sanic(name)
         self.fan_reg = SanicRegister(name, port=self._port)
         self.task_classes = []
@@ -138,13 +148,16 @@ class SanicServiceHelper:
             if request.get('fan_ctx'):
                 return
 
-            discovery = await get_discovery(name=self.app.name, loop=loop)
+            discovery = self.discovery
             tracer = discovery.tracer
 
             span_context = tracer.extract('http', request.headers)
+            deadline = HTTPPropagator.extract_deadline(request.headers)
+            if deadline_expired(deadline):
+                return text('Deadline exceeded', status=504)
             name = '{} {}'.format(request.method, request.path)
             if span_context:
-                 ctx = AsyncContext(discovery, None, span_context, name)
+                ctx = AsyncContext(discovery, None, span_context, name, deadline=deadline)
             else:
                 # TODO: Extract same code for django and sanic
                 baggage = {}
@@ -152,7 +165,7 @@ class SanicServiceHelper:
                     h = request.headers.get(k)
                     if h is not None:
                         baggage[v] = h
-                ctx = AsyncContext(discovery, None, None, name, baggage)
+                ctx = AsyncContext(discovery, None, None, name, baggage, deadline)
 
             await ctx.__aenter__()
             request['fan_ctx'] = ctx
@@ -174,6 +187,7 @@ class SanicServiceHelper:
         for task_class in self.task_classes:
             self.workers.append(task_class.task(loop=loop))
         server = self.app.create_server(host=self._host, port=self._port, **kwargs)
+        self.discovery = await get_discovery(name=self.app.name, loop=loop)
         self.prepare_app(loop=loop)
         self.sanic_server = asyncio.ensure_future(server, loop=loop)
         await self.fan_reg.register(loop=loop)
@@ -184,3 +198,6 @@ class SanicServiceHelper:
             self.sanic_server.cancel()
         for worker in self.workers:
             worker.stop()
+        if self.discovery is not None:
+            await self.discovery.tracer.flush()
+            await self.discovery.close_http_session()
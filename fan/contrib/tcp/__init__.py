@@ -0,0 +1,203 @@
+import asyncio
+import os
+import stat
+import struct
+
+from fan.remote import RemoteEndpoint, unhost
+from fan.contrib.aio.remote import AIOTransport
+
+
+HEADER = struct.Struct('!I')  # length of frame body
+
+
+class Connection:
+    """
+    Stream of length prefixed frames, messages are encoded with codec
+    """
+    def __init__(self, reader, writer, codec, max_frame_size):
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.max_frame_size = max_frame_size
+        # drain() can't be awaited concurrently
+        self.lock = asyncio.Lock()
+
+    async def read(self):
+        size, = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+        if size > self.max_frame_size:
+            raise ValueError('Frame of {} bytes exceeds limit {}'.format(size,
+                                                                        self.max_frame_size))
+        return self.codec.decode(await self.reader.readexactly(size))
+
+    async def write(self, msg):
+        data = self.codec.encode(msg)
+        if len(data) > self.max_frame_size:
+            raise ValueError('Frame of {} bytes exceeds limit {}'.format(len(data),
+                                                                        self.max_frame_size))
+        async with self.lock:
+            self.writer.write(HEADER.pack(len(data)) + data)
+            # waits while the socket buffer is above write_buffer_limit
+            await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class TCPTransport(AIOTransport):
+    """
+    Direct calls over TCP (`host`, `port` params, 0 port is any free one) or unix socket
+    (`path` param) without broker.
+    Proxy keeps one connection, concurrent calls are multiplexed over it and matched with
+    responses by span id. Remote reads next request only when it has a free slot
+    of `max_in_flight`, so busy service pushes back on callers through TCP flow control
+    """
+    max_frame_size = 16 * 1024 * 1024  # bigger frames are rejected, connection is closed
+    write_buffer_limit = 256 * 1024  # writers wait for the socket when more is buffered
+    connect_timeout = 5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = self.params.get('path')
+        self.address = self.path or '{host}:{port}'.format(**self.params)
+        self.server = None
+        self.serving = {}  # remote: connection => task reading its requests
+        self.connection = None  # proxy: connection shared by all calls
+        self.connecting = asyncio.Lock()
+        self._read = None
+
+    def new_connection(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=self.get_param('write_buffer_limit'))
+        return Connection(reader, writer, self.message_codec, self.get_param('max_frame_size'))
+
+    async def on_start(self):
+        if self.remote:
+            await self.start_server()
+        self.started = True
+
+    async def on_stop(self):
+        self.stopped = True
+        if self.remote:
+            await self.stop_server()
+        else:
+            self.disconnect()
+
+    async def start_server(self):
+        if self.path:
+            # socket file of previous run
+            if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+            self.server = await asyncio.start_unix_server(self.serve, self.path)
+        else:
+            host = self.params.get('bind', self.params.get('host'))
+            self.server = await asyncio.start_server(self.serve, host, self.params['port'])
+            if not self.params['port']:
+                # port is chosen by system, callers get it with registered config
+                port = self.server.sockets[0].getsockname()[1]
+                self.params = dict(self.params, port=port)
+                self.endpoint.remote_params = self.params
+                self.address = '{host}:{port}'.format(**self.params)
+        self.log.debug('Listen {}'.format(self.address))
+
+    async def stop_server(self):
+        # stop accepting and reading, answer requests in progress and close connections
+        self.server.close()
+        serving = dict(self.serving)
+        for task in serving.values():
+            task.cancel()
+        await self.drain()
+        for conn in serving:
+            conn.close()
+        await self.server.wait_closed()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def serve(self, reader, writer):
+        conn = self.new_connection(reader, writer)
+        task = asyncio.ensure_future(self.serve_connection(conn))
+        self.serving[conn] = task
+        try:
+            await task
+        finally:
+            self.serving.pop(conn, None)
+
+    async def serve_connection(self, conn):
+        try:
+            while not self.stopped:
+                await self.semaphore.acquire()
+                try:
+                    msg = await conn.read()
+                    if not isinstance(msg, dict):
+                        raise ValueError('Frame is not a message: {!r}'.format(type(msg)))
+                    msg['connection'] = conn
+                except BaseException:
+                    self.semaphore.release()
+                    raise
+                self.track(self.dispatch(msg))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.log.debug('Caller disconnected')
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.log.exception('Bad request, close connection')
+        finally:
+            # on stop connection is closed when requests in progress are answered
+            if not self.stopped:
+                conn.close()
+
+    async def remote_send_response(self, request, response):
+        try:
+            await request['connection'].write(response)
+        except ConnectionError:
+            self.log.warning('Caller of {} disconnected'.format(request['method']))
+
+    async def connect(self):
+        if self.connection is None:
+            async with self.connecting:
+                if self.connection is None:
+                    conn = self.new_connection(*await asyncio.wait_for(
+                        self.open_connection(), self.get_param('connect_timeout')))
+                    self._read = asyncio.ensure_future(self.read_responses(conn))
+                    self.connection = conn
+        return self.connection
+
+    def open_connection(self):
+        if self.path:
+            return asyncio.open_unix_connection(self.path)
+        return asyncio.open_connection(self.params['host'], self.params['port'])
+
+    def disconnect(self):
+        if self._read:
+            self._read.cancel()
+            self._read = None
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    async def read_responses(self, conn):
+        try:
+            while True:
+                self.proxy_send_response(await conn.read())
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.log.warning('Connection to {} is lost: {!r}'.format(self.address, e))
+            if self.connection is conn:
+                self.connection = None
+                self._read = None
+            conn.close()
+            # calls waiting for this connection won't get responses, next call reconnects
+            self.terminate(ConnectionError('Connection to {} is lost'.format(self.address)))
+
+    async def rpc_inner_call(self, msg, future):
+        conn = await self.connect()
+        await conn.write(msg)
+        return await future
+
+
+class TCPEndpoint(RemoteEndpoint):
+    async def on_start(self):
+        await self.transport.on_start()
+
+    async def on_stop(self):
+        unhost(self)
+        await self.transport.on_stop()
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.context import Context
+from fan.contrib.aio.remote import AIOProxyEndpoint
+from fan.contrib.tcp import TCPEndpoint, TCPTransport
+from fan.discovery import LocalDiscovery, SimpleDictDiscovery
+from fan.service import Service, endpoint
+
+
+class TCPDiscovery(LocalDiscovery):
+    def get_transport_class(self, name):
+        return TCPTransport
+
+
+class EchoService(Service):
+    name = 'echo'
+
+    def __init__(self):
+        super().__init__()
+        self.running = 0
+        self.max_running = 0
+
+    @endpoint
+    async def echo(self, ctx, word, delay=0):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(delay)
+        self.running -= 1
+        return word
+
+    @endpoint
+    def upper(self, ctx, word):
+        return word.upper()
+
+
+@pytest.fixture
+def discovery():
+    discovery = TCPDiscovery()
+    discovery.tracer = BasicTracer(InMemoryRecorder())
+    return discovery
+
+
+@pytest.fixture
+def started():
+    return []
+
+
+async def stop_all(started):
+    for endpoint in reversed(started):
+        if not endpoint.transport.stopped:
+            await endpoint.on_stop()
+
+
+async def start_pair(discovery, started, **params):
+    params = dict({'transport': 'tcp', 'host': '127.0.0.1', 'port': 0}, **params)
+    service = EchoService()
+    remote = TCPEndpoint(discovery, service, params)
+    await remote.on_start()
+    started.append(remote)
+    proxy = AIOProxyEndpoint(discovery, ('echo',), remote.remote_params)
+    await proxy.on_start()
+    started.append(proxy)
+    return service, remote, proxy
+
+
+async def call(discovery, proxy, method, *args, **kwargs):
+    with Context(discovery) as ctx:
+        return await proxy.perform_call(ctx, method, *args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_multiplexing(discovery, started):
+    try:
+        service, remote, proxy = await start_pair(discovery, started)
+        words = ['w{}'.format(i) for i in range(20)]
+        calls = [call(discovery, proxy, 'echo', word, delay=0.02) for word in words]
+        assert await asyncio.gather(*calls) == words
+        assert service.max_running == 20
+        assert await call(discovery, proxy, 'upper', 'ok') == 'OK'
+        assert len(remote.transport.serving) == 1
+    finally:
+        await stop_all(started)
+
+
+@pytest.mark.asyncio
+async def test_unix_socket(discovery, started):
+    try:
+        path = os.path.join(tempfile.mkdtemp(), 'echo.sock')
+        service, remote, proxy = await start_pair(discovery, started, path=path, max_in_flight=2)
+        calls = [call(discovery, proxy, 'echo', i, delay=0.01) for i in range(5)]
+        assert await asyncio.gather(*calls) == list(range(5))
+        # remote doesn't read more requests than it handles at once
+        assert service.max_running == 2
+        await proxy.on_stop()
+        await remote.on_stop()
+        assert not os.path.exists(path)
+    finally:
+        await stop_all(started)
+
+
+@pytest.mark.asyncio
+async def test_codec(discovery, started):
+    try:
+        params = {'transport': 'tcp', 'host': '127.0.0.1', 'port': 0,
+                  'codec': ['missing', 'fast_json']}
+        registry = SimpleDictDiscovery({})
+        remote = TCPEndpoint(discovery, EchoService(), params)
+        await remote.on_start()
+        started.append(remote)
+        registry.register(remote)
+        assert params['codec'] == ['missing', 'fast_json']
+        # remote has chosen the codec, callers get it with registered config
+        config = registry.find_endpoint(['echo'], None)
+        assert config['codec'] == 'fast_json'
+        proxy = AIOProxyEndpoint(discovery, ('echo',), config)
+        await proxy.on_start()
+        started.append(proxy)
+        assert proxy.transport.message_codec is remote.transport.message_codec
+        assert await call(discovery, proxy, 'echo', {'items': list(range(100))}) == \
+            {'items': list(range(100))}
+    finally:
+        await stop_all(started)
+
+
+@pytest.mark.asyncio
+async def test_reconnect(discovery, started):
+    try:
+        service, remote, proxy = await start_pair(discovery, started)
+        pending = asyncio.ensure_future(call(discovery, proxy, 'echo', 'lost', delay=0.2))
+        await asyncio.sleep(0.01)
+        # server drops the connection, waiting call fails at once
+        for conn in list(remote.transport.serving):
+            conn.close()
+        with pytest.raises(ConnectionError):
+            await pending
+        assert await call(discovery, proxy, 'echo', 'again') == 'again'
+    finally:
+        await stop_all(started)
+
+
+@pytest.mark.asyncio
+async def test_bad_frame(discovery, started):
+    try:
+        service, remote, proxy = await start_pair(discovery, started, max_in_flight=1)
+        conn = await proxy.transport.connect()
+        await conn.write(['not', 'a', 'message'])
+        await asyncio.sleep(0.05)
+        # connection is dropped, request slot is given back
+        assert not remote.transport.serving
+        assert await asyncio.wait_for(call(discovery, proxy, 'echo', 'ok'), 1) == 'ok'
+    finally:
+        await stop_all(started)
@@ -1,6 +1,6 @@
 import logging
 
-from fan.remote import LocalEndpoint, Endpoint, ProxyEndpoint, RemoteEndpoint
+from fan.remote import LocalEndpoint, Endpoint, ProxyEndpoint, RemoteEndpoint, host
 
 
 def path_set(obj, path, what):
@@ -35,20 +35,23 @@ class LocalDiscovery:
     Service types:
         singleton - only a single service allowed
         round_robin - any worker can handle request
-        shard - only a concrete worker can handle request
+        shard - only a concrete worker can handle request, see `shard_key` of methods
     """
     def __init__(self):
         self.log = logging.getLogger(self.__class__.__name__)
         self.cached_endpoints = {}
+        self.generation = 0  # changed when registered endpoint is replaced, invalidates rpc stubs
 
     def register(self, endpoint: Endpoint):
         if isinstance(endpoint, LocalEndpoint):
             service = endpoint.service
             path = tuple(service.name.split('.'))
-            self.cached_endpoints[path] = endpoint
         else:
             path = tuple(endpoint.name)
-            self.cached_endpoints[path] = endpoint
+        # stubs are cached only for found endpoints, new paths don't affect them
+        if path in self.cached_endpoints:
+            self.generation += 1
+        self.cached_endpoints[path] = endpoint
 
     def find_endpoint(self, service_name, version_filter=None):
         if service_name in self.cached_endpoints:
@@ -89,11 +92,20 @@ def version_filter(constraints):
 
 
 class CompositeDiscovery:
+    short_circuit = True  # proxies call endpoints served by this process directly
+
     def __init__(self, local, remote):
         self.log = logging.getLogger(self.__class__.__name__)
         self.local = local
         self.remote = remote
 
+    @property
+    def generation(self):
+        local = getattr(self.local, 'generation', None)
+        remote = getattr(self.remote, 'generation', None)
+        if local is not None and remote is not None:
+            return local, remote
+
     def find_endpoint(self, name, version_filter=[]):
         local = self.local.find_endpoint(name, version_filter)
         if local:
@@ -111,6 +123,7 @@ class CompositeDiscovery:
         self.local.register(endpoint)
         if isinstance(endpoint, RemoteEndpoint):
             self.remote.register(endpoint)
+            host(endpoint)
 
     # TODO: transport info should go from process
     def get_transport_class(self, name):
@@ -121,8 +134,10 @@ class SimpleDictDiscovery(RemoteDiscovery):
     def __init__(self, conf):
         super().__init__()
         self.data = conf
+        self.generation = 0
 
     def register(self, endpoint):
+        self.generation += 1
         path, data = endpoint.service.name.split('.'), endpoint.remote_params
         path_set(self.data, path, data)
 
@@ -2,6 +2,32 @@ class RPCException(Exception):
     pass
 
 
+class RPCTimeout(RPCException):
+    pass
+
+
+class DeadlineExceeded(RPCTimeout):
+    pass
+
+
+class CircuitOpenError(RPCException):
+    """
+    Instance failed recently, call is rejected without trying
+    """
+
+
+class ConcurrencyLimitExceeded(RPCException):
+    """
+    Too many calls in flight to endpoint, call is rejected without trying
+    """
+
+
+class RemoteError(RPCException):
+    """
+    Remote endpoint failed to handle the call
+    """
+
+
 class RPCHttpError(RPCException):
     def __init__(self, response):
         self.response = response
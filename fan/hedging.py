@@ -0,0 +1,58 @@
+from collections import deque
+
+from fan.retry import RetryBudget, method_policies
+
+
+class HedgePolicy:
+    '''
+    Options come from `hedge` item of endpoint params or method config.
+    Fixed `delay` or `percentile` of observed latency once there are `min_samples`,
+    `default_delay` is used until then
+    '''
+    def __init__(self, delay=None, percentile=0.95, default_delay=0.05, min_delay=0.001,
+                 min_samples=20):
+        self.delay = delay
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+
+    def get_delay(self, latency):
+        if self.delay is not None:
+            return self.delay
+        if len(latency) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, latency.percentile(self.percentile))
+
+
+class LatencyTracker:
+    '''
+    Latencies of last `size` successful calls
+    '''
+    def __init__(self, size=100):
+        self.samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def percentile(self, p):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def hedge_policies(params, idempotent):
+    return method_policies(params, 'hedge', HedgePolicy, idempotent)
+
+
+def get_hedge_budget(params):
+    '''
+    Extra requests are limited to `ratio` of hedged calls, 10% by default
+    '''
+    config = params.get('hedge')
+    options = {'ratio': 0.1, 'min_per_second': 0, 'max_tokens': 10}
+    if isinstance(config, dict):
+        options.update(config.get('budget', {}))
+    return RetryBudget(**options)
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from fan.circuit import is_failure
+from fan.exceptions import ConcurrencyLimitExceeded
+
+
+class ConcurrencyLimiter:
+    '''
+    Bulkhead with AIMD limit of calls in flight: limit grows by one while calls succeed
+    and use at least half of it, shrinks by `backoff` on failed or slower than
+    `latency_threshold` calls. Calls over limit wait in queue of `max_queue` size
+    for at most `queue_timeout`, when queue is full they are rejected at once
+    '''
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=200, backoff=0.9,
+                 latency_threshold=1, max_queue=50, queue_timeout=1):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_threshold = latency_threshold
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.cond = threading.Condition()
+
+    @property
+    def stats(self):
+        return {'limit': int(self.limit), 'in_flight': self.in_flight, 'queued': self.waiting,
+                'rejected': self.rejected}
+
+    @property
+    def has_slot(self):
+        return self.in_flight < int(self.limit)
+
+    def reject(self, reason):
+        self.rejected += 1
+        raise ConcurrencyLimitExceeded('{}, limit {}'.format(reason, int(self.limit)))
+
+    def on_sample(self, latency, failed):
+        if failed or latency > self.latency_threshold:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif self.in_flight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+    def acquire(self):
+        with self.cond:
+            if not self.has_slot:
+                if self.waiting >= self.max_queue:
+                    self.reject('Queue is full')
+                self.waiting += 1
+                try:
+                    if not self.cond.wait_for(lambda: self.has_slot, self.queue_timeout):
+                        self.reject('Queue timeout')
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+
+    def release(self, latency=None, failed=False):
+        '''
+        latency is None when call was interrupted and tells nothing about the endpoint
+        '''
+        with self.cond:
+            if latency is not None:
+                self.on_sample(latency, failed)
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def run(self, fn):
+        self.acquire()
+        started = time.monotonic()
+        latency, failed = None, False
+        try:
+            result = fn()
+            latency = time.monotonic() - started
+            return result
+        except Exception as e:
+            latency, failed = time.monotonic() - started, is_failure(e)
+            raise
+        finally:
+            self.release(latency, failed)
+
+
+class AsyncConcurrencyLimiter(ConcurrencyLimiter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiters = deque()
+        self.reserved = 0  # slots given to woken up waiters, that haven't taken them yet
+
+    @property
+    def has_slot(self):
+        return self.in_flight + self.reserved < int(self.limit)
+
+    async def acquire(self):
+        if not self.has_slot or self.waiters:
+            if len(self.waiters) >= self.max_queue:
+                self.reject('Queue is full')
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(waiter, self.queue_timeout)
+            except BaseException as e:
+                self.waiting -= 1
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # woken up, but cancelled before taking the slot: hand it to the next one
+                    self.reserved -= 1
+                    self.wake_up()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.reject('Queue timeout')
+                raise
+            self.waiting -= 1
+            self.reserved -= 1
+        self.in_flight += 1
+
+    def release(self, latency=None, failed=False):
+        if latency is not None:
+            self.on_sample(latency, failed)
+        self.in_flight -= 1
+        self.wake_up()
+
+    def wake_up(self):
+        while self.waiters and self.has_slot:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.reserved += 1
+
+    async def run(self, fn):
+        await self.acquire()
+        started = time.monotonic()
+        latency, failed = None, False
+        try:
+            result = await fn()
+            latency = time.monotonic() - started
+            return result
+        except asyncio.CancelledError:
+            # e.g. lost hedge, neither success nor failure of the endpoint
+            raise
+        except Exception as e:
+            latency, failed = time.monotonic() - started, is_failure(e)
+            raise
+        finally:
+            self.release(latency, failed)
+
+
+def get_limiter(config, limiter_class=ConcurrencyLimiter):
+    '''
+    Limiter from `concurrency_limit` endpoint param: True or dict of limiter options
+    '''
+    if not config:
+        return None
+    if config is True:
+        return limiter_class()
+    return limiter_class(**config)
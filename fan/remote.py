@@ -1,4 +1,69 @@
+import functools
+import inspect
+import json
 import logging
+import time
+import weakref
+
+from fan.balancer import get_balancer
+from fan.circuit import get_breaker
+from fan.exceptions import CircuitOpenError, RPCException
+from fan.limiter import ConcurrencyLimiter, get_limiter
+from fan.retry import get_budget, retry_policies
+from fan.sharding import HashRing, get_shard, shard_keys
+from fan.utils import SingleFlight
+
+
+IDEMPOTENT_HTTP_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# remote endpoints served by this process, keyed by their registered config
+hosted_endpoints = weakref.WeakValueDictionary()
+
+
+def coalesced_methods(params):
+    """
+    Names of methods whose identical concurrent calls may share one request.
+    Method config `coalesce` flag wins, otherwise endpoint `coalesce` param enables it
+    for idempotent methods: marked with `idempotent` flag or GET like http ones
+    """
+    enabled = params.get('coalesce', False)
+    names = set()
+    for method in params.get('methods', []):
+        if method.get('coalesce', enabled and is_idempotent(method)):
+            names.add(method['name'])
+    return names
+
+
+def is_idempotent(method):
+    return method.get('idempotent', method.get('method', '').upper() in IDEMPOTENT_HTTP_METHODS)
+
+
+def call_key(method_name, args, kwargs):
+    """
+    Identical calls have same key, None if arguments can't be compared reliably
+    """
+    try:
+        return method_name, json.dumps([args, kwargs], sort_keys=True)
+    except TypeError:
+        return None
+
+
+def config_key(params):
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+def host(endpoint):
+    """
+    Remember that this process serves `endpoint`, so calls resolved to its config
+    don't have to go through the transport
+    """
+    hosted_endpoints[config_key(endpoint.remote_params)] = endpoint
+
+
+def unhost(endpoint):
+    key = config_key(endpoint.remote_params)
+    if hosted_endpoints.get(key) is endpoint:
+        del hosted_endpoints[key]
 
 
 class Transport:
@@ -10,6 +75,12 @@ class Transport:
         self.started = False
         self.stopped = False
 
+    def get_param(self, name):
+        """
+        endpoint params override transport defaults defined as class attributes
+        """
+        return self.params.get(name, getattr(self, name))
+
     def on_start(self):
         self.started = True
 
@@ -40,20 +111,155 @@ class Endpoint:
 
 
 class ProxyEndpoint(Endpoint):
-    def __init__(self, discovery, name, params):
-        self.log = logging.getLogger(self.__class__.__name__)
-        self.name = name
+    single_flight_class = SingleFlight  # coalesces identical calls of idempotent methods
+    limiter_class = ConcurrencyLimiter  # bulkhead enabled by `concurrency_limit` param
+    short_circuit = True  # config hosted by this process is called directly, skipping transport
+
+    def __init__(self, discovery, name, params, instance=False):
+        """
+        instance: endpoint is an instance of BalancedProxyEndpoint, which applies call policies
+        """
+        self.init_proxy(discovery, name)
         self.params = params
-        self.discovery = discovery
         transportClass = discovery.get_transport_class(params['transport'])
         self.transport = transportClass(discovery, self, params)
+        self.breaker = get_breaker(params.get('circuit_breaker'))
+        if self.short_circuit:
+            self.hosted_key = config_key(params)
+        if not instance:
+            self.init_policies(params)
+
+    def init_proxy(self, discovery, name):
+        """
+        attributes shared by single and balanced proxies
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.name = name
+        self.discovery = discovery
+        self.outstanding = 0
+        self.breaker = None
+        self.short_circuit = getattr(discovery, 'short_circuit', self.short_circuit)
+        self.hosted_key = None
+
+    def init_policies(self, params):
+        self.limiter = get_limiter(params.get('concurrency_limit'), self.limiter_class)
+        self.flights = self.single_flight_class()
+        self.retry_budget = get_budget(params)
+        self._policies = (None, None)
+
+    @property
+    def policies(self):
+        """
+        per method policies derived from params, recomputed when params change
+        """
+        params = self.params
+        if self._policies[0] is not params:
+            self._policies = (params, self.method_policies(params or {}))
+        return self._policies[1]
+
+    def method_policies(self, params):
+        return {'coalesce': coalesced_methods(params),
+                'retry': retry_policies(params, is_idempotent)}
+
+    def coalesce_key(self, method_name, args, kwargs):
+        if method_name in self.policies['coalesce']:
+            return call_key(method_name, args, kwargs)
 
     def perform_call(self, ctx, method_name, *args, **kwargs):
+        key = self.coalesce_key(method_name, args, kwargs)
+        call = functools.partial(self.call_with_retries, ctx, method_name, *args, **kwargs)
+        if self.limiter:
+            # coalesced calls share the slot of the first one
+            call = functools.partial(self.limiter.run, call)
+        if key is None:
+            return call()
+        if key in self.flights:
+            # own span of the caller, request is made within the first caller's one
+            ctx.span.set_tag('coalesced', True)
+        return self.flights.do(key, call)
+
+    def call_with_retries(self, ctx, method_name, *args, **kwargs):
+        policy = self.policies['retry'].get(method_name)
+        if policy is None:
+            return self.call(ctx, method_name, *args, **kwargs)
+        self.retry_budget.on_request()
+        tried = []
+        attempt = 1
+        while True:
+            try:
+                if attempt == 1:
+                    return self.attempt(ctx, tried, method_name, args, kwargs)
+                with ctx.create_child_context(name='retry {}'.format(attempt)) as retry_ctx:
+                    retry_ctx.span.set_tag('retry', attempt)
+                    return self.attempt(retry_ctx, tried, method_name, args, kwargs)
+            except Exception as e:
+                attempt += 1
+                delay = self.retry_delay(ctx, policy, attempt, e)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    def retry_delay(self, ctx, policy, attempt, error):
+        """
+        backoff before `attempt` or None if call shouldn't be retried
+        """
+        if attempt > policy.max_attempts or not policy.should_retry(error):
+            return None
+        delay = policy.delay(attempt)
+        time_left = ctx.time_left()
+        if time_left is not None and time_left <= delay:
+            return None
+        if not self.retry_budget.withdraw():
+            self.log.warning('Retry budget of {} is exhausted'.format(self.name))
+            return None
+        return delay
+
+    def attempt(self, ctx, tried, method_name, args, kwargs):
+        """
+        single try of a call, `tried` collects instances used by previous attempts
+        """
+        return self.call(ctx, method_name, *args, **kwargs)
+
+    def find_local(self):
+        """
+        endpoint serving this config in this process while it's running
+        """
+        if self.hosted_key is not None:
+            return hosted_endpoints.get(self.hosted_key)
+
+    def rpc_call(self, method_name, ctx, *args, **kwargs):
+        local = self.find_local()
+        if local is not None:
+            ctx.check_deadline()
+            result = local.perform_call(ctx, method_name, *args, **kwargs)
+            if inspect.isgenerator(result):
+                # transports return streamed results as lists, in-process call does the same
+                result = list(result)
+            return result
         if not self.transport.started:
             self.transport.on_start()
-        # ctx.span.operation_name = method_name
         return self.transport.rpc_call(method_name, ctx, *args, **kwargs)
 
+    def call(self, ctx, method_name, *args, **kwargs):
+        # ctx.span.operation_name = method_name
+        if self.breaker is None:
+            return self.rpc_call(method_name, ctx, *args, **kwargs)
+        started = self.breaker.before_call()
+        try:
+            result = self.rpc_call(method_name, ctx, *args, **kwargs)
+        except Exception as e:
+            self.breaker.after_call(started, e)
+            raise
+        except BaseException:
+            self.breaker.cancel_call()
+            raise
+        self.breaker.after_call(started)
+        return result
+
+    @property
+    def available(self):
+        return self.breaker is None or self.breaker.available
+
     def on_start(self):
         self.transport.on_start()
 
@@ -61,6 +267,99 @@ class ProxyEndpoint(Endpoint):
         return self.transport.on_stop()
 
 
+class BalancedProxyEndpoint(ProxyEndpoint):
+    """
+    Spreads calls between all registered instances of a service.
+    Every instance is a ProxyEndpoint with own transport, configs are keyed by instance id.
+    Calls of methods with `shard_key` go to the owner of the key on a consistent hash ring
+    """
+    instance_class = ProxyEndpoint
+    vnodes = 100  # points of every instance on the shard ring
+
+    def __init__(self, discovery, name, configs, balancer='round_robin'):
+        self.init_proxy(discovery, name)
+        self.balancer = get_balancer(balancer)
+        self.instances = {}
+        self.instance_list = []
+        self.ring = HashRing(vnodes=self.vnodes)
+        self.update_instances(configs)
+        self.init_policies(self.params or {})
+
+    @property
+    def params(self):
+        """
+        config of the most recently registered instance
+        """
+        return self.instance_list[-1].params if self.instance_list else None
+
+    def update_instances(self, configs):
+        """
+        Keep instances with unchanged config, returns removed ones, that should be stopped
+        """
+        removed = []
+        for key, instance in list(self.instances.items()):
+            if configs.get(key) != instance.params:
+                removed.append(self.instances.pop(key))
+        added = [key for key in configs if key not in self.instances]
+        for key in added:
+            self.instances[key] = self.instance_class(self.discovery, self.name, configs[key],
+                                                      instance=True)
+        self.instance_list = [self.instances[key] for key in sorted(self.instances)]
+        self.ring.update(self.instances)
+        if removed or added:
+            self.log.debug('Instances of {}: {}'.format(self.name, sorted(self.instances)))
+        return removed
+
+    def method_policies(self, params):
+        policies = super().method_policies(params)
+        policies['shard'] = shard_keys(params)
+        return policies
+
+    def shard(self, method_name, args, kwargs):
+        shard_key = self.policies['shard'].get(method_name)
+        if shard_key is not None:
+            return get_shard(shard_key, args, kwargs)
+
+    def choose_instance(self, exclude=(), shard=None):
+        """
+        exclude: instances to avoid if there are others, e.g. already tried ones
+        shard: key of sharded call, its owner is chosen or the next instance on the ring
+        """
+        if not self.instance_list:
+            raise RPCException('No instances of {}'.format(self.name))
+        # instances with open circuit are ejected until it's time to try them again
+        available = [i for i in self.instance_list if i.available]
+        if not available:
+            raise CircuitOpenError('All instances of {} are failing'.format(self.name))
+        if shard is not None:
+            ordered = [self.instances[key] for key in self.ring.lookup(shard)]
+            ordered = [i for i in ordered if i.available]
+            return next((i for i in ordered if i not in exclude), ordered[0])
+        if exclude:
+            available = [i for i in available if i not in exclude] or available
+        return self.balancer.choose(available)
+
+    def call(self, ctx, method_name, *args, **kwargs):
+        return self.attempt(ctx, [], method_name, args, kwargs)
+
+    def attempt(self, ctx, tried, method_name, args, kwargs):
+        instance = self.choose_instance(tried, self.shard(method_name, args, kwargs))
+        tried.append(instance)
+        instance.outstanding += 1
+        try:
+            return instance.call(ctx, method_name, *args, **kwargs)
+        finally:
+            instance.outstanding -= 1
+
+    def on_start(self):
+        for instance in self.instance_list:
+            instance.on_start()
+
+    def on_stop(self):
+        for instance in self.instance_list:
+            instance.on_stop()
+
+
 class LocalEndpoint(Endpoint):
     """
     For in-process communications only
@@ -97,6 +396,7 @@ class RemoteEndpoint(LocalEndpoint):
         self.transport.on_start()
 
     def on_stop(self):
+        unhost(self)
         return self.transport.on_stop()
 
     def __getattr__(self, name):
@@ -0,0 +1,115 @@
+import asyncio
+import random
+import threading
+import time
+
+from fan.exceptions import (AioRPCHttpError, CircuitOpenError, DeadlineExceeded, RPCHttpError,
+                            RPCTimeout)
+
+
+class RetryBudget:
+    '''
+    Token bucket limiting retries to `ratio` of requests, plus `min_per_second`
+    retries allowed regardless of traffic, so low traffic services can retry too
+    '''
+    def __init__(self, ratio=0.1, min_per_second=1, max_tokens=100):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.exhausted = 0
+
+    def _refill(self, amount):
+        now = time.monotonic()
+        amount += (now - self.last) * self.min_per_second
+        self.last = now
+        self.tokens = min(self.max_tokens, self.tokens + amount)
+
+    def on_request(self):
+        with self.lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            self._refill(0)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.exhausted += 1
+            return False
+
+
+class RetryPolicy:
+    '''
+    Options come from `retry` item of endpoint params or method config
+    '''
+    def __init__(self, max_attempts=3, backoff=0.05, max_backoff=1, jitter=True,
+                 statuses=(500, 502, 503, 504), timeouts=True):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses
+        self.timeouts = timeouts
+
+    def should_retry(self, error):
+        if isinstance(error, DeadlineExceeded):
+            return False
+        if isinstance(error, RPCHttpError):
+            return error.response.status_code in self.statuses
+        if isinstance(error, AioRPCHttpError):
+            return error.status in self.statuses
+        if isinstance(error, CircuitOpenError):
+            return True
+        if isinstance(error, (RPCTimeout, asyncio.TimeoutError)):
+            return self.timeouts
+        return isinstance(error, (OSError, ConnectionError))
+
+    def delay(self, attempt):
+        '''
+        exponential backoff before `attempt` (2 for the first retry), full jitter
+        '''
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 2))
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+def method_policies(params, name, policy_class, idempotent):
+    '''
+    Policy per method name. Endpoint `name` param (true or dict of options) applies to
+    idempotent methods or to methods listed in its `methods` item,
+    method config `name` item overrides it (false disables policy for the method)
+    '''
+    config = params.get(name)
+    options = dict(config) if isinstance(config, dict) else {}
+    names = options.pop('methods', None)
+    options.pop('budget', None)
+    default = policy_class(**options) if config else None
+    policies = {}
+    methods = params.get('methods', [])
+    for method in methods:
+        method_name = method['name']
+        if name in method:
+            if method[name]:
+                method_options = method[name] if isinstance(method[name], dict) else {}
+                policies[method_name] = policy_class(**dict(options, **method_options))
+        elif default and (method_name in names if names is not None else idempotent(method)):
+            policies[method_name] = default
+    configured = {method['name'] for method in methods}
+    for method_name in names or []:
+        if method_name not in configured:
+            policies[method_name] = default
+    return policies
+
+
+def retry_policies(params, idempotent):
+    return method_policies(params, 'retry', RetryPolicy, idempotent)
+
+
+def get_budget(params, name='retry'):
+    '''
+    Budget shared by all methods of endpoint, options from `budget` item of `name` param
+    '''
+    config = params.get(name)
+    return RetryBudget(**(config.get('budget', {}) if isinstance(config, dict) else {}))
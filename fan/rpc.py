@@ -1,54 +1,198 @@
+import asyncio
 import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from weakref import WeakKeyDictionary
 
-from fan.exceptions import RPCException
+from fan.exceptions import RPCException, RPCTimeout
+
+FAN_OUT_WORKERS = 32  # threads of pool shared by sync fan_out calls
+executor = None
+executor_lock = threading.Lock()
+
+
+class Stub:
+    """
+    Call path resolved to endpoint with precomputed span name
+    """
+    __slots__ = ('endpoint', 'method_name', 'span_name')
+
+    def __init__(self, endpoint, call_path):
+        self.endpoint = endpoint
+        self.method_name = call_path[-1]
+        self.span_name = '.'.join(call_path)
+
+
+class StubCache:
+    """
+    Stubs per discovery, dropped when discovery `generation` changes.
+    Discoveries without generation don't cache endpoints themselves, so stubs aren't cached either
+    """
+    def __init__(self):
+        self.discoveries = WeakKeyDictionary()
+
+    def get(self, discovery, call_path):
+        cached = self.discoveries.get(discovery)
+        if cached and cached[0] == getattr(discovery, 'generation', None):
+            return cached[1].get(call_path)
+
+    def set(self, discovery, call_path, stub):
+        generation = getattr(discovery, 'generation', None)
+        if generation is None:
+            return
+        cached = self.discoveries.get(discovery)
+        if not cached or cached[0] != generation:
+            cached = self.discoveries[discovery] = (generation, {})
+        cached[1][call_path] = stub
+
+
+stubs = StubCache()
+
+
+def resolve(discovery, call_path, endpoint):
+    """
+    Stub of found endpoint, kept until discovery changes.
+    Module level, so callers have no attributes hiding remote methods
+    """
+    if not endpoint:
+        raise RPCException('No such endpoint')
+    stub = Stub(endpoint, call_path)
+    stubs.set(discovery, call_path, stub)
+    return stub
 
 
 class Caller:
     log = logging.getLogger('Caller')
 
-    def __init__(self, parent_context, name, call_path=[]):
+    def __init__(self, parent_context, name, call_path=()):
         self.parent_context = parent_context
-        self.call_path = call_path + [name]
+        self.call_path = call_path + (name,)
 
     def __getattr__(self, name):
         '''
-        Make copy of self, usefull for caches, like:
+        Make child of self, usefull for caches, like:
         >>> app = ctx.rpc.app
         >>> author = app.author
         >>> author.list()
         >>> author.delete(id=1)
+        Child is kept as attribute, so next access doesn't create it again
         '''
-        return self.__class__(self.parent_context, name, self.call_path)
+        caller = self.__class__(self.parent_context, name, self.call_path)
+        self.__dict__[name] = caller
+        return caller
 
     def __call__(self, *args, **kwargs):
-        self.log.debug('Generate call: {} {} {}'.format(self.call_path, args, kwargs))
-        endpoint = self.parent_context.discovery.find_endpoint(
-            tuple(self.call_path[:-1]), version_filter=None
-        )
-        self.log.debug('RPCEndpoint: {}'.format(endpoint))
-        if endpoint:
-            name = '.'.join(self.call_path)
-            with self.parent_context.create_child_context(name=name) as ctx:
-                method_name = self.call_path[-1]
-                return endpoint.perform_call(ctx, method_name, *args, **kwargs)
-        else:
-            raise RPCException('No such endpoint')
+        discovery = self.parent_context.discovery
+        stub = stubs.get(discovery, self.call_path)
+        if stub is None:
+            self.log.debug('Generate call: {} {} {}'.format(self.call_path, args, kwargs))
+            endpoint = discovery.find_endpoint(self.call_path[:-1], version_filter=None)
+            stub = resolve(discovery, self.call_path, endpoint)
+            self.log.debug('RPCEndpoint: {}'.format(stub.endpoint))
+        with self.parent_context.create_child_context(name=stub.span_name) as ctx:
+            return stub.endpoint.perform_call(ctx, stub.method_name, *args, **kwargs)
 
 
 class AsyncCaller(Caller):
     async def __call__(self, *args, **kwargs):
-        self.log.debug('Generate call: {} {} {}'.format(self.call_path, args, kwargs))
-        endpoint = await self.parent_context.discovery.find_endpoint(
-            tuple(self.call_path[:-1]), version_filter=None
-        )
-        self.log.debug('RPCEndpoint: {}'.format(endpoint))
-        if endpoint:
-            name = '.'.join(self.call_path)
-            async with self.parent_context.create_child_context(name=name) as ctx:
-                method_name = self.call_path[-1]
-                return await endpoint.perform_call(ctx, method_name, *args, **kwargs)
-        else:
-            raise RPCException('No such endpoint')
+        discovery = self.parent_context.discovery
+        stub = stubs.get(discovery, self.call_path)
+        if stub is None:
+            self.log.debug('Generate call: {} {} {}'.format(self.call_path, args, kwargs))
+            endpoint = await discovery.find_endpoint(self.call_path[:-1], version_filter=None)
+            stub = resolve(discovery, self.call_path, endpoint)
+            self.log.debug('RPCEndpoint: {}'.format(stub.endpoint))
+        async with self.parent_context.create_child_context(name=stub.span_name) as ctx:
+            return await stub.endpoint.perform_call(ctx, stub.method_name, *args, **kwargs)
+
+
+class CallResult:
+    """
+    Outcome of a single fan_out call: either value or error
+    """
+    __slots__ = ('value', 'error')
+
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def __repr__(self):
+        return '<CallResult {!r}>'.format(self.error if self.error else self.value)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(FAN_OUT_WORKERS, thread_name_prefix='fan_out')
+    return executor
+
+
+def fan_out(calls, limit=None, timeout=None):
+    """
+    Run calls in shared thread pool. Timed out calls can't be interrupted,
+    they keep running in background, but their results are dropped
+    """
+    calls = list(calls)
+    results = [None] * len(calls)
+    pending = {}  # future => (index, deadline)
+    queue = iter(enumerate(calls))
+    pool = get_executor()
+
+    def submit():
+        for i, call in queue:
+            pending[pool.submit(call)] = (i, timeout and time.monotonic() + timeout)
+            if limit and len(pending) >= limit:
+                break
+
+    submit()
+    while pending:
+        wait_for = None
+        if timeout:
+            wait_for = max(0, min(d for _, d in pending.values()) - time.monotonic())
+        done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+        for f in done:
+            i, _ = pending.pop(f)
+            error = f.exception()
+            results[i] = CallResult(error=error) if error else CallResult(f.result())
+        if timeout:
+            now = time.monotonic()
+            for f, (i, deadline) in list(pending.items()):
+                if deadline <= now:
+                    del pending[f]
+                    results[i] = CallResult(error=RPCTimeout('No result in {}s'.format(timeout)))
+        submit()
+    return results
+
+
+async def async_fan_out(calls, limit=None, timeout=None):
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def run(call):
+        try:
+            if semaphore:
+                async with semaphore:
+                    return CallResult(await asyncio.wait_for(call(), timeout))
+            return CallResult(await asyncio.wait_for(call(), timeout))
+        except asyncio.TimeoutError:
+            return CallResult(error=RPCTimeout('No result in {}s'.format(timeout)))
+        except asyncio.CancelledError:
+            # cancelled fan_out has no results to collect, Exception catches it before 3.8
+            raise
+        except Exception as e:
+            return CallResult(error=e)
+
+    return await asyncio.gather(*[run(call) for call in calls])
 
 
 class RPC:
@@ -57,4 +201,19 @@ class RPC:
         self.async_call = async_caller
 
     def __getattr__(self, name):
-        return (AsyncCaller if self.async_call else Caller)(self.context, name)
+        caller = (AsyncCaller if self.async_call else Caller)(self.context, name)
+        self.__dict__[name] = caller
+        return caller
+
+    def fan_out(self, calls, limit=None, timeout=None):
+        """
+        Run batch of calls concurrently, at most `limit` at once, each one within `timeout`.
+        Calls are callables without arguments, every rpc call gets own child span:
+        >>> results = await ctx.rpc.fan_out([functools.partial(ctx.rpc.item.get, id=i)
+                                              for i in ids], limit=10, timeout=1)
+        Returns CallResult for every call in the same order, failed calls don't affect others.
+        Sync contexts run calls in shared thread pool, avoid nested fan_out there
+        """
+        if self.async_call:
+            return async_fan_out(calls, limit, timeout)
+        return fan_out(calls, limit, timeout)
@@ -0,0 +1,68 @@
+'''
+Head-based samplers. Decision is made once for the root span, child spans and remote calls
+inherit it with propagated `sampled` flag. Spans that are not sampled are not recorded at all
+'''
+import os
+import random
+import threading
+import time
+
+from basictracer.recorder import Sampler
+
+
+class ConstSampler(Sampler):
+    def __init__(self, decision=True):
+        self.decision = decision
+
+    def sampled(self, trace_id):
+        return self.decision
+
+
+class ProbabilitySampler(Sampler):
+    '''
+    Samples `rate` part of traces, 0 <= rate <= 1
+    '''
+    def __init__(self, rate):
+        assert 0 <= rate <= 1, rate
+        self.rate = rate
+
+    def sampled(self, trace_id):
+        return random.random() < self.rate
+
+
+class RateLimitingSampler(Sampler):
+    '''
+    Samples at most `per_second` traces per second (token bucket, allows bursts up to
+    one second worth of traces)
+    '''
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self.tokens = per_second
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def sampled(self, trace_id):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.per_second, self.tokens + (now - self.last) * self.per_second)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+def get_sampler(rate=None, per_second=None):
+    '''
+    Sampler from arguments or TRACE_SAMPLE_RATE / TRACE_SAMPLE_PER_SECOND env variables,
+    samples everything when nothing is configured
+    '''
+    if rate is None and 'TRACE_SAMPLE_RATE' in os.environ:
+        rate = float(os.environ['TRACE_SAMPLE_RATE'])
+    if per_second is None and 'TRACE_SAMPLE_PER_SECOND' in os.environ:
+        per_second = float(os.environ['TRACE_SAMPLE_PER_SECOND'])
+    if per_second is not None:
+        return RateLimitingSampler(per_second)
+    if rate is not None:
+        return ProbabilitySampler(rate)
+    return ConstSampler(True)
@@ -0,0 +1,73 @@
+import bisect
+import hashlib
+
+from fan.exceptions import RPCException
+
+
+def hash_key(key):
+    return int(hashlib.md5(str(key).encode('utf8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    '''
+    Consistent hash ring. Every node is placed at `vnodes` points, so keys are spread
+    evenly and adding or removing a node moves only its share of keys
+    '''
+    def __init__(self, nodes=(), vnodes=100):
+        self.vnodes = vnodes
+        self.nodes = set()
+        self.points = []  # sorted hashes of virtual nodes
+        self.owners = []  # node of every point
+        self.update(nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def update(self, nodes):
+        nodes = set(nodes)
+        if nodes == self.nodes:
+            return
+        ring = sorted((hash_key('{}#{}'.format(node, i)), node)
+                      for node in nodes for i in range(self.vnodes))
+        self.points = [point for point, _ in ring]
+        self.owners = [node for _, node in ring]
+        self.nodes = nodes
+
+    def lookup(self, key):
+        '''
+        nodes in preference order: owner of the key, then next distinct nodes clockwise
+        '''
+        if not self.points:
+            return
+        start = bisect.bisect(self.points, hash_key(key))
+        seen = set()
+        for i in range(len(self.points)):
+            node = self.owners[(start + i) % len(self.points)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+    def get(self, key):
+        return next(self.lookup(key), None)
+
+
+def shard_keys(params):
+    '''
+    `shard_key` of method configs: argument name, position of argument
+    or url like template of keyword arguments: '/store/{shard1}/item/{shard2}/'
+    '''
+    return {method['name']: method['shard_key'] for method in params.get('methods', [])
+            if method.get('shard_key') is not None}
+
+
+def get_shard(shard_key, args, kwargs):
+    try:
+        if isinstance(shard_key, int):
+            return args[shard_key]
+        if '{' in shard_key:
+            return shard_key.format(**kwargs)
+        return kwargs[shard_key]
+    except (IndexError, KeyError) as e:
+        raise RPCException('Missing shard key {}: {}'.format(shard_key, e)) from e
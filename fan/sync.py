@@ -1,9 +1,12 @@
 '''
 Shortlived sync helpers. Primary target is creating short-lived fast context with get_context
 '''
+import atexit
 import logging
 import os
 import socket
+import threading
+from collections import deque
 from functools import wraps
 
 import requests
@@ -16,11 +19,13 @@ from py_zipkin.zipkin import ZipkinAttrs
 
 from fan.context import Context
 from fan.contrib.kazoo.discovery import KazooDiscovery
+from fan.sampling import get_sampler
 from fan.transport import HTTPTransport, HTTPPropagator, DjangoPropagator
 
 discovery = None
 tracer = None
 ZIPKIN = os.environ.get('ZIPKIN')
+ZIPKIN_TIMEOUT = 10  # Timeout to send spans batch to zipkin over http
 
 
 def http_transport(encoded_span):
@@ -38,11 +43,133 @@ def http_transport(encoded_span):
 log = logging.getLogger('fan.sync')
 
 
-def zipkin_log_span(span_id, parent_span_id, trace_id, span_name, annotations, binary_annotations,
-                    timestamp_s, duration_s, **kwargs):
+def encode_span(span_id, parent_span_id, trace_id, span_name, annotations, binary_annotations,
+                timestamp_s, duration_s, **kwargs):
     span = create_span(span_id, parent_span_id, trace_id, span_name, annotations,
                        binary_annotations, timestamp_s, duration_s)
-    http_transport(encode_bytes_list([span_to_bytes(span)]))
+    return span_to_bytes(span)
+
+
+def zipkin_log_span(**kwargs):
+    http_transport(encode_bytes_list([encode_span(**kwargs)]))
+
+
+class BaseSpanExporter:
+    '''
+    Bounded queue of thrift-encoded spans, that are sent to zipkin in batches
+    '''
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    headers = {'Content-Type': 'application/x-thrift'}
+
+    def __init__(self, zipkin, max_queue_size=10000, batch_size=100, flush_interval=1,
+                 policy=DROP_OLDEST):
+        assert policy in (self.DROP_OLDEST, self.DROP_NEWEST), policy
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.url = 'http://{}/api/v1/spans'.format(zipkin)
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.queue = deque()
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def stats(self):
+        return {
+            'queued': len(self.queue),
+            'exported': self.exported,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _enqueue(self, encoded_span):
+        if len(self.queue) >= self.max_queue_size:
+            self.dropped += 1
+            if self.policy == self.DROP_NEWEST:
+                return False
+            self.queue.popleft()
+        self.queue.append(encoded_span)
+        return True
+
+    def _take_batch(self):
+        size = min(len(self.queue), self.batch_size)
+        return [self.queue.popleft() for _ in range(size)]
+
+
+class SpanExporter(BaseSpanExporter):
+    '''
+    Sends spans from background thread, so recording span costs only append to queue
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.pid = os.getpid()
+        self.stopping = False
+        atexit.register(self.stop)
+
+    def ensure_started(self):
+        if self.pid != os.getpid():
+            # thread doesn't survive fork, so prefork servers need a new one in every worker
+            self.pid = os.getpid()
+            self.cond = threading.Condition()
+            self.thread = None
+            self.queue.clear()
+        if self.thread:
+            return
+        with self.cond:
+            if self.thread:
+                return
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run, name='fan-span-exporter',
+                                           daemon=True)
+            self.thread.start()
+
+    def export(self, encoded_span):
+        self.ensure_started()
+        with self.cond:
+            added = self._enqueue(encoded_span)
+            if len(self.queue) >= self.batch_size:
+                self.cond.notify()
+        return added
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.stopping and len(self.queue) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+                batch = self._take_batch()
+                done = self.stopping and not self.queue
+            if batch:
+                self.send(batch)
+            if done:
+                return
+
+    def send(self, batch):
+        try:
+            resp = self.session.post(self.url, data=encode_bytes_list(batch),
+                                     headers=self.headers, timeout=ZIPKIN_TIMEOUT)
+            resp.raise_for_status()
+            self.exported += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            self.log.warning('Failed to send {} spans to zipkin: {!r}'.format(len(batch), e))
+
+    def stop(self, timeout=ZIPKIN_TIMEOUT):
+        '''
+        Flush queued spans and stop background thread
+        '''
+        if not self.thread or self.pid != os.getpid():
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        self.thread = None
 
 
 class BaseFanRecorder(SpanRecorder):
@@ -104,7 +231,7 @@ class BaseFanRecorder(SpanRecorder):
             'span_name': span.operation_name or 'no_name',
 
             'flags': 0,  # for ZipkinAttrs
-            'is_sampled': True,  # for ZipkinAttrs
+            'is_sampled': bool(ctx.sampled),  # for ZipkinAttrs
             'endpoint': self.endpoint_info,  # for annotation
 
             'timestamp_s': span.start_time,
@@ -115,22 +242,41 @@ class BaseFanRecorder(SpanRecorder):
 
 
 class FanRecorder(BaseFanRecorder):
+    def __init__(self, name, send_to_zipkin):
+        super().__init__(name, send_to_zipkin)
+        self.exporter = send_to_zipkin and SpanExporter(send_to_zipkin)
+
     def record_span(self, span):
         if self.send_to_zipkin:
-            zipkin_log_span(**self.zipkin_span_params(span))
+            self.exporter.export(encode_span(**self.zipkin_span_params(span)))
 
         log.info('Log span: {}'.format(self.log_span_params(span)))
 
         return super().record_span(span)
 
 
+class FanTracer(BasicTracer):
+    """
+    Records only sampled spans, so unsampled ones cost neither logging nor zipkin encoding.
+    Spans finished with error are recorded anyway when record_errors is on
+    """
+    record_errors = True
+
+    def should_record(self, span):
+        return span.context.sampled or (self.record_errors and 'error' in span.tags)
+
+    def record(self, span):
+        if self.should_record(span):
+            self.recorder.record_span(span)
+
+
 def get_tracer(name=None):
     global tracer
     if tracer:
         return tracer
 
     recorder = FanRecorder(name or 'no_name', send_to_zipkin=ZIPKIN)
-    tracer = BasicTracer(recorder)
+    tracer = FanTracer(recorder, sampler=get_sampler())
     return tracer
 
 
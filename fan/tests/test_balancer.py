@@ -0,0 +1,100 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.balancer import LeastOutstanding, PowerOfTwoChoices, get_balancer
+from fan.context import Context
+from fan.discovery import LocalDiscovery
+from fan.remote import BalancedProxyEndpoint, ProxyEndpoint, Transport
+
+
+class InstanceTransport(Transport):
+    def rpc_call(self, method, ctx, *args, **kwargs):
+        return self.params['id']
+
+
+class BalancerDiscovery(LocalDiscovery):
+    def get_transport_class(self, name):
+        return InstanceTransport
+
+
+class Instance:
+    def __init__(self, outstanding):
+        self.outstanding = outstanding
+
+
+class BalancerCase(TestCase):
+    def setUp(self):
+        self.discovery = BalancerDiscovery()
+        self.discovery.tracer = BasicTracer(InMemoryRecorder())
+        self.configs = {'i{}'.format(i): {'transport': 'dummy', 'id': i} for i in range(3)}
+
+    def call(self, endpoint):
+        with Context(self.discovery) as ctx:
+            return endpoint.perform_call(ctx, 'ping')
+
+    def test_round_robin(self):
+        endpoint = BalancedProxyEndpoint(self.discovery, 'svc', self.configs)
+        self.assertEqual([self.call(endpoint) for _ in range(6)], [0, 1, 2, 0, 1, 2])
+        self.assertTrue(endpoint.available)
+        # call policies are applied once, by the balanced endpoint
+        self.assertFalse(hasattr(endpoint.instances['i0'], 'retry_budget'))
+
+    def test_least_outstanding(self):
+        instances = [Instance(2), Instance(0), Instance(1)]
+        self.assertIs(LeastOutstanding().choose(instances), instances[1])
+        for _ in range(10):
+            self.assertIsNot(PowerOfTwoChoices().choose(instances), instances[0])
+
+    def test_random(self):
+        endpoint = BalancedProxyEndpoint(self.discovery, 'svc', self.configs, 'random')
+        counts = Counter(self.call(endpoint) for _ in range(100))
+        self.assertEqual(set(counts), {0, 1, 2})
+
+    def test_update_instances(self):
+        endpoint = BalancedProxyEndpoint(self.discovery, 'svc', self.configs)
+        kept = endpoint.instances['i1']
+        configs = {'i1': self.configs['i1'], 'i3': {'transport': 'dummy', 'id': 3}}
+        removed = endpoint.update_instances(configs)
+        self.assertEqual(sorted(i.params['id'] for i in removed), [0, 2])
+        self.assertIs(endpoint.instances['i1'], kept)
+        self.assertEqual(sorted(self.call(endpoint) for _ in range(2)), [1, 3])
+
+    def test_get_balancer(self):
+        self.assertIsInstance(get_balancer('power_of_two'), PowerOfTwoChoices)
+        self.assertIsInstance(get_balancer(LeastOutstanding), LeastOutstanding)
+
+
+class SlowTransport(Transport):
+    def rpc_call(self, method, ctx, *args, **kwargs):
+        self.endpoint.calls += 1
+        time.sleep(0.05)
+        return args
+
+
+class CoalesceCase(TestCase):
+    def setUp(self):
+        self.discovery = BalancerDiscovery()
+        self.discovery.tracer = BasicTracer(InMemoryRecorder())
+        self.discovery.get_transport_class = lambda name: SlowTransport
+
+    def test_coalesce_get(self):
+        params = {'transport': 'slow', 'coalesce': True,
+                  'methods': [{'name': 'get', 'method': 'GET'}, {'name': 'post', 'method': 'POST'}]}
+        endpoint = ProxyEndpoint(self.discovery, 'svc', params)
+        endpoint.calls = 0
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda i: self.call(endpoint, 'get', 1), range(4)))
+        self.assertEqual(results, [(1,)] * 4)
+        self.assertEqual(endpoint.calls, 1)
+        with ThreadPoolExecutor(2) as pool:
+            list(pool.map(lambda i: self.call(endpoint, 'post', 1), range(2)))
+        self.assertEqual(endpoint.calls, 3)
+
+    def call(self, endpoint, method, *args):
+        with Context(self.discovery) as ctx:
+            return endpoint.perform_call(ctx, method, *args)
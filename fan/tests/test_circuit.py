@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.circuit import CircuitBreaker
+from fan.context import Context
+from fan.discovery import LocalDiscovery
+from fan.exceptions import CircuitOpenError, RPCTimeout
+from fan.remote import BalancedProxyEndpoint, Transport
+
+
+class FailingTransport(Transport):
+    def rpc_call(self, method, ctx, *args, **kwargs):
+        if self.params['id'] == 0:
+            raise RPCTimeout()
+        return self.params['id']
+
+
+class FailingDiscovery(LocalDiscovery):
+    def get_transport_class(self, name):
+        return FailingTransport
+
+
+class CircuitBreakerCase(TestCase):
+    def call(self, breaker, error=None):
+        started = breaker.before_call()
+        breaker.after_call(started, error)
+
+    def test_open_and_close(self):
+        breaker = CircuitBreaker(window=4, min_calls=4, failure_rate=0.5, open_timeout=10)
+        for error in [None, ValueError(), RPCTimeout()]:
+            self.call(breaker, error)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.call(breaker, RPCTimeout())
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+        breaker.opened_at -= 10
+        self.assertTrue(breaker.available)
+        started = breaker.before_call()
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        breaker.after_call(started)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_slow_calls(self):
+        breaker = CircuitBreaker(min_calls=2, slow_call_duration=0, slow_call_rate=1)
+        self.call(breaker)
+        self.call(breaker)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_eject_instance(self):
+        discovery = FailingDiscovery()
+        discovery.tracer = BasicTracer(InMemoryRecorder())
+        breaker = {'min_calls': 2, 'window': 2}
+        configs = {'i{}'.format(i): {'transport': 'failing', 'id': i, 'circuit_breaker': breaker}
+                   for i in range(2)}
+        endpoint = BalancedProxyEndpoint(discovery, 'svc', configs)
+        results = []
+        for _ in range(6):
+            with Context(discovery) as ctx:
+                try:
+                    results.append(endpoint.perform_call(ctx, 'ping'))
+                except RPCTimeout:
+                    results.append('timeout')
+        self.assertEqual(results, ['timeout', 1, 'timeout', 1, 1, 1])
+        self.assertFalse(endpoint.instances['i0'].available)
+
+    def test_cancelled_trial(self):
+        breaker = CircuitBreaker(min_calls=1, open_timeout=0)
+        self.call(breaker, RPCTimeout())
+        self.assertEqual(breaker.state, breaker.OPEN)
+        breaker.before_call()
+        self.assertFalse(breaker.available)
+        breaker.cancel_call()
+        # neither closed nor opened again, next trial is allowed
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertTrue(breaker.available)
+        self.call(breaker)
+        self.assertEqual(breaker.state, breaker.CLOSED)
@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+from fan.codecs import CODECS, Codec, choose_codec, get_codec, register_codec
+
+
+class ReversedCodec(Codec):
+    name = 'reversed'
+
+    def encode(self, obj):
+        return obj[::-1]
+
+    def decode(self, data):
+        return data[::-1]
+
+
+class CodecsCase(TestCase):
+    msg = {'context_headers': {'span_id': 1, 'sampled': True}, 'method': 'echo',
+           'args': [[1, 2.5, 'ю', None]], 'kwargs': {}}
+
+    def test_roundtrip(self):
+        for name, codec in CODECS.items():
+            data = codec.encode(self.msg)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(codec.decode(data), self.msg, name)
+        # all json backends are compatible
+        self.assertEqual(get_codec('fast_json').decode(get_codec('json').encode(self.msg)),
+                         self.msg)
+        msg = {'response': {1: 2 ** 70}}
+        self.assertEqual(get_codec('json').decode(get_codec('fast_json').encode(msg)),
+                         {'response': {'1': 2 ** 70}})
+
+    def test_raw(self):
+        codec = get_codec('raw')
+        request = dict(self.msg, args=(b'\x00data', 1), kwargs={'extra': bytearray(b'\xff')})
+        self.assertEqual(codec.decode(codec.encode(request)),
+                         dict(self.msg, args=[b'\x00data', 1], kwargs={'extra': b'\xff'}))
+        response = {'context_headers': {'span_id': 1}, 'method': 'echo', 'response': b'\x00'}
+        self.assertEqual(codec.decode(codec.encode(response)), response)
+        self.assertEqual(codec.decode(codec.encode({'response': [1]})), {'response': [1]})
+
+    def test_choose(self):
+        self.assertEqual(choose_codec(['missing', 'json']), 'json')
+        self.assertEqual(choose_codec('raw'), 'raw')
+        with self.assertRaises(ValueError):
+            get_codec(['missing'])
+        register_codec(ReversedCodec())
+        try:
+            self.assertEqual(get_codec('reversed').encode(b'ab'), b'ba')
+        finally:
+            del CODECS['reversed']
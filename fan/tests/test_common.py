@@ -1,4 +1,8 @@
-from fan.utils import _make_key
+import asyncio
+
+import pytest
+
+from fan.utils import AsyncCache, _make_key, async_cache
 
 
 def test_make_key():
@@ -10,3 +14,42 @@ def test_make_key():
     key1 = _make_key(args, kwargs)
     key2 = _make_key(args, kwargs)
     assert key1 == key2, 'Keys must be the same'
+
+
+@pytest.mark.asyncio
+async def test_async_cache_single_flight():
+    calls = []
+
+    @async_cache
+    async def load(name):
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        return name.upper()
+
+    results = await asyncio.gather(*[load('a') for _ in range(5)])
+    assert results == ['A'] * 5
+    assert calls == ['a']
+    assert await load('a') == 'A'
+    assert load.cache.stats['coalesced'] == 4
+    assert load.cache.stats['hits'] == 1
+
+
+@pytest.mark.asyncio
+async def test_async_cache_lru_ttl():
+    cache = AsyncCache(max_size=2, ttl=10)
+    for key in 'abc':
+        cache.set(key, key)
+    assert 'a' not in cache and 'b' in cache and 'c' in cache
+    assert cache.stats['evictions'] == 1
+
+    cache.set('b', 'b', ttl=0)
+    assert 'b' not in cache
+    cache.invalidate('c')
+    assert len(cache) == 0
+
+    async def fail():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        await cache.get('d', fail)
+    assert 'd' not in cache
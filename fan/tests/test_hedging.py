@@ -0,0 +1,14 @@
+from unittest import TestCase
+
+from fan.hedging import HedgePolicy, LatencyTracker
+
+
+class HedgingCase(TestCase):
+    def test_hedge_delay(self):
+        latency = LatencyTracker()
+        policy = HedgePolicy(min_samples=10, default_delay=0.5)
+        self.assertEqual(policy.get_delay(latency), 0.5)
+        for i in range(100):
+            latency.add(i / 100)
+        self.assertEqual(policy.get_delay(latency), 0.95)
+        self.assertEqual(HedgePolicy(delay=0.1).get_delay(latency), 0.1)
@@ -0,0 +1,204 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+
+import pytest
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.context import Context
+from fan.discovery import LocalDiscovery
+from fan.exceptions import DeadlineExceeded
+from fan.transport import (AsyncHTTPTransport, DjangoPropagator, HTTPTransport, HTTPPropagator,
+                           create_client_session)
+from fan.transport.cache import ResponseCache
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        self.server.deadlines.append(HTTPPropagator.extract_deadline(self.headers))
+        self.server.statuses.append(200)
+        body = json.dumps({'path': self.path}).encode()
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.server.statuses[-1] = 304
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = HTTPServer(('127.0.0.1', 0), EchoHandler)
+    server.clients = set()
+    server.deadlines = []
+    server.statuses = []
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def server_params(server):
+    return {
+        'transport': 'http',
+        'host': '127.0.0.1',
+        'port': server.server_port,
+        'methods': [{'name': 'ping', 'url': '/ping/', 'method': 'GET'},
+                    {'name': 'item', 'url': '/item/{id}/', 'method': 'GET',
+                     'cache': {'ttl': 10, 'key_fields': ['id']}}],
+    }
+
+
+def create_discovery(discovery_class=LocalDiscovery):
+    discovery = discovery_class()
+    discovery.tracer = BasicTracer(InMemoryRecorder())
+    discovery.tracer.register_propagator('http', HTTPPropagator())
+    return discovery
+
+
+class HTTPServerCase(TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.discovery = create_discovery()
+        self.params = server_params(self.server)
+
+    def tearDown(self):
+        stop_server(self.server)
+
+    def call(self, transport, method_name, **kwargs):
+        with Context(self.discovery) as ctx:
+            return transport.rpc_call(method_name, ctx, **kwargs)
+
+
+class HTTPTransportCase(HTTPServerCase):
+    def test_keep_alive(self):
+        transport = HTTPTransport(self.discovery, None, self.params)
+        transport.on_start()
+        for _ in range(5):
+            self.assertEqual(self.call(transport, 'ping'), {'path': '/ping/'})
+        transport.on_stop()
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertIsNone(transport.session)
+
+    def test_evict_idle(self):
+        transport = HTTPTransport(self.discovery, None, dict(self.params, pool_idle_timeout=0.01))
+        transport.on_start()
+        self.call(transport, 'ping')
+        transport.last_used -= 1
+        self.call(transport, 'ping')
+        transport.on_stop()
+        self.assertEqual(len(self.server.clients), 2)
+
+    def test_deadline(self):
+        transport = HTTPTransport(self.discovery, None, self.params)
+        with Context(self.discovery) as ctx:
+            ctx.set_timeout(10)
+            with ctx.create_child_context() as child:
+                self.assertEqual(child.deadline, ctx.deadline)
+                transport.rpc_call('ping', child)
+            ctx.deadline = time.time() - 1
+            with self.assertRaises(DeadlineExceeded):
+                transport.rpc_call('ping', ctx)
+        transport.on_stop()
+        self.assertEqual(len(self.server.deadlines), 1)
+        self.assertAlmostEqual(self.server.deadlines[0], time.time() + 10, delta=1)
+
+    def test_propagate_deadline(self):
+        headers = HTTPPropagator.inject_deadline(123.5, {})
+        self.assertEqual(HTTPPropagator.extract_deadline(headers), 123.5)
+        self.assertIsNone(HTTPPropagator.extract_deadline({}))
+        meta = {'HTTP_OT_DEADLINE': headers['ot-deadline']}
+        self.assertEqual(DjangoPropagator.extract_deadline(meta), 123.5)
+
+    def test_response_cache(self):
+        transport = HTTPTransport(self.discovery, None, self.params)
+        expected = {'path': '/item/1/?id=1'}
+        for _ in range(3):
+            self.assertEqual(self.call(transport, 'item', id=1), expected)
+        self.assertEqual(self.server.statuses, [200])
+        cache = transport.caches['item']
+        cache.entries[cache.make_key({'id': 1})].expires_at = 0
+        self.assertEqual(self.call(transport, 'item', id=1), expected)
+        self.assertEqual(self.server.statuses, [200, 304])
+        self.assertEqual(cache.stats['revalidated'], 1)
+        transport.on_stop()
+
+    def test_shared_cache(self):
+        transports = [HTTPTransport(self.discovery, None, self.params) for _ in range(2)]
+        self.assertIs(transports[0].caches['item'], transports[1].caches['item'])
+        for transport in transports:
+            self.assertEqual(self.call(transport, 'item', id=1), {'path': '/item/1/?id=1'})
+            transport.on_stop()
+        self.assertEqual(self.server.statuses, [200])
+        other = LocalDiscovery()
+        self.assertIsNot(HTTPTransport(other, None, self.params).caches['item'],
+                         transports[0].caches['item'])
+
+    def test_cache_size_limit(self):
+        cache = ResponseCache(max_entries=3, max_bytes=10)
+        for key in 'abc':
+            cache.set(key, b'12345')
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        self.assertEqual(cache.size, 10)
+        cache.set('d', b'x' * 11)
+        self.assertIsNone(cache.get('d'))
+
+
+class SharedSessionDiscovery(LocalDiscovery):
+    def __init__(self):
+        super().__init__()
+        self.http_session = None
+
+    def get_http_session(self):
+        if self.http_session is None:
+            self.http_session = create_client_session()
+        return self.http_session
+
+
+@pytest.fixture
+def http_server():
+    server = start_server()
+    yield server
+    stop_server(server)
+
+
+@pytest.mark.asyncio
+async def test_async_shared_session(http_server):
+    discovery = create_discovery(SharedSessionDiscovery)
+    transports = [AsyncHTTPTransport(discovery, None, server_params(http_server))
+                  for _ in range(2)]
+    for transport in transports:
+        with Context(discovery) as ctx:
+            assert await transport.rpc_call('ping', ctx) == {'path': '/ping/'}
+        await transport.on_stop()
+    assert not discovery.http_session.closed
+    await discovery.http_session.close()
+    assert len(http_server.clients) == 1
+
+
+@pytest.mark.asyncio
+async def test_async_response_cache(http_server):
+    discovery = create_discovery()
+    transport = AsyncHTTPTransport(discovery, None, server_params(http_server))
+    for _ in range(2):
+        with Context(discovery) as ctx:
+            assert await transport.rpc_call('item', ctx, id=2) == {'path': '/item/2/?id=2'}
+    assert http_server.statuses == [200]
+    await transport.on_stop()
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+from unittest import TestCase
+
+import pytest
+
+from fan.exceptions import ConcurrencyLimitExceeded, RPCTimeout
+from fan.limiter import AsyncConcurrencyLimiter, ConcurrencyLimiter
+
+
+class ConcurrencyLimiterCase(TestCase):
+    def test_aimd(self):
+        limiter = ConcurrencyLimiter(initial_limit=2, max_limit=3, backoff=0.5,
+                                     latency_threshold=1)
+        limiter.acquire()
+        limiter.release(0.1)
+        self.assertEqual(limiter.limit, 3)
+        limiter.acquire()
+        limiter.release(0.1)
+        self.assertEqual(limiter.limit, 3)
+        limiter.acquire()
+        limiter.release(2)
+        self.assertEqual(limiter.limit, 1.5)
+        with self.assertRaises(RPCTimeout):
+            limiter.run(self.timeout)
+        self.assertEqual(limiter.limit, 1)
+        # caller errors are not a sign of overload
+        with self.assertRaises(ValueError):
+            limiter.run(self.value_error)
+        self.assertEqual(limiter.stats, {'limit': 2, 'in_flight': 0, 'queued': 0,
+                                         'rejected': 0})
+
+    def timeout(self):
+        raise RPCTimeout()
+
+    def value_error(self):
+        raise ValueError()
+
+    def test_queue(self):
+        limiter = ConcurrencyLimiter(initial_limit=1, max_queue=1, queue_timeout=1)
+        limiter.acquire()
+        waiter = threading.Thread(target=limiter.run, args=(lambda: None,))
+        waiter.start()
+        while not limiter.waiting:
+            pass
+        with self.assertRaises(ConcurrencyLimitExceeded):
+            limiter.acquire()
+        self.assertEqual(limiter.stats['queued'], 1)
+        limiter.release(0.1)
+        waiter.join()
+        self.assertEqual(limiter.stats['in_flight'], 0)
+        self.assertEqual(limiter.stats['rejected'], 1)
+
+    def test_queue_timeout(self):
+        limiter = ConcurrencyLimiter(initial_limit=1, queue_timeout=0.01)
+        limiter.acquire()
+        with self.assertRaises(ConcurrencyLimitExceeded):
+            limiter.acquire()
+        self.assertEqual(limiter.stats['queued'], 0)
+        self.assertEqual(limiter.stats['rejected'], 1)
+
+
+@pytest.mark.asyncio
+async def test_async_cancel():
+    limiter = AsyncConcurrencyLimiter(initial_limit=1, max_limit=1, queue_timeout=1)
+    running = asyncio.ensure_future(limiter.run(lambda: asyncio.sleep(1)))
+    await asyncio.sleep(0)
+    waiting = asyncio.ensure_future(limiter.run(lambda: asyncio.sleep(0)))
+    await asyncio.sleep(0)
+    assert limiter.stats['queued'] == 1
+    # cancelled call gives its slot back without changing the limit
+    running.cancel()
+    await asyncio.sleep(0)
+    assert limiter.reserved == 1
+    # waiter woken up, but cancelled before taking the slot, hands it over
+    last = asyncio.ensure_future(limiter.run(lambda: asyncio.sleep(0, 'last')))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    assert await last == 'last'
+    assert limiter.stats == {'limit': 1, 'in_flight': 0, 'queued': 0, 'rejected': 0}
+    assert limiter.reserved == 0
@@ -0,0 +1,90 @@
+import time
+from unittest import TestCase
+
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.context import Context
+from fan.discovery import LocalDiscovery
+from fan.exceptions import RPCTimeout
+from fan.remote import BalancedProxyEndpoint, Transport
+from fan.retry import RetryBudget, RetryPolicy, retry_policies
+
+
+class FlakyTransport(Transport):
+    def rpc_call(self, method, ctx, *args, **kwargs):
+        self.endpoint.calls += 1
+        if self.params['id'] == 0:
+            raise RPCTimeout()
+        return self.params['id']
+
+
+class FlakyDiscovery(LocalDiscovery):
+    def get_transport_class(self, name):
+        return FlakyTransport
+
+
+class RetryCase(TestCase):
+    def setUp(self):
+        self.recorder = InMemoryRecorder()
+        self.discovery = FlakyDiscovery()
+        self.discovery.tracer = BasicTracer(self.recorder)
+
+    def endpoint(self, retry, ids=(0, 1)):
+        methods = [{'name': 'get', 'method': 'GET'}, {'name': 'post', 'method': 'POST'}]
+        configs = {'i{}'.format(i): {'transport': 'flaky', 'id': i, 'retry': retry,
+                                     'methods': methods} for i in ids}
+        endpoint = BalancedProxyEndpoint(self.discovery, 'svc', configs)
+        for instance in endpoint.instance_list:
+            instance.calls = 0
+        return endpoint
+
+    def call(self, endpoint, method, timeout=None):
+        with Context(self.discovery, name='call') as ctx:
+            if timeout is not None:
+                ctx.set_timeout(timeout)
+            return endpoint.perform_call(ctx, method)
+
+    def test_retry_other_instance(self):
+        endpoint = self.endpoint({'backoff': 0})
+        self.assertEqual([self.call(endpoint, 'get') for _ in range(4)], [1] * 4)
+        # first attempts alternate, retries go to the other instance
+        self.assertEqual(endpoint.instances['i1'].calls, 4)
+        names = [s.operation_name for s in self.recorder.get_spans()]
+        self.assertEqual(names.count('retry 2'), endpoint.instances['i0'].calls)
+
+    def test_not_idempotent(self):
+        endpoint = self.endpoint({'backoff': 0})
+        with self.assertRaises(RPCTimeout):
+            self.call(endpoint, 'post')
+
+    def test_budget(self):
+        endpoint = self.endpoint({'backoff': 0, 'budget': {'ratio': 0, 'min_per_second': 0,
+                                                            'max_tokens': 1}}, ids=[0])
+        with self.assertRaises(RPCTimeout):
+            self.call(endpoint, 'get')
+        self.assertEqual(endpoint.instances['i0'].calls, 2)
+        self.assertEqual(endpoint.retry_budget.exhausted, 1)
+
+    def test_deadline(self):
+        endpoint = self.endpoint({'backoff': 10, 'jitter': False}, ids=[0])
+        started = time.monotonic()
+        with self.assertRaises(RPCTimeout):
+            self.call(endpoint, 'get', timeout=1)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(endpoint.instances['i0'].calls, 1)
+
+    def test_policies(self):
+        params = {'retry': {'max_attempts': 5, 'methods': ['ping']},
+                  'methods': [{'name': 'get', 'method': 'GET'},
+                              {'name': 'post', 'method': 'POST', 'retry': {'max_attempts': 2}}]}
+        policies = retry_policies(params, lambda m: m['method'] == 'GET')
+        self.assertEqual(sorted(policies), ['ping', 'post'])
+        self.assertEqual(policies['post'].max_attempts, 2)
+        self.assertEqual(RetryPolicy(backoff=1, max_backoff=3, jitter=False).delay(4), 3)
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=1)
+        budget.tokens = 0
+        budget.on_request()
+        self.assertFalse(budget.withdraw())
+        budget.on_request()
+        self.assertTrue(budget.withdraw())
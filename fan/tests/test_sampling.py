@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+from basictracer.recorder import InMemoryRecorder
+
+from fan.context import Context
+from fan.discovery import LocalDiscovery
+from fan.sampling import ConstSampler, ProbabilitySampler, RateLimitingSampler, get_sampler
+from fan.sync import FanTracer
+
+
+class SamplerCase(TestCase):
+    def test_probability(self):
+        self.assertFalse(any(ProbabilitySampler(0).sampled(i) for i in range(100)))
+        self.assertTrue(all(ProbabilitySampler(1).sampled(i) for i in range(100)))
+
+    def test_rate_limit(self):
+        sampler = RateLimitingSampler(2)
+        self.assertEqual([sampler.sampled(i) for i in range(3)], [True, True, False])
+        sampler.last -= 1
+        self.assertTrue(sampler.sampled(3))
+
+    def test_get_sampler(self):
+        self.assertIsInstance(get_sampler(), ConstSampler)
+        self.assertIsInstance(get_sampler(rate=0.1), ProbabilitySampler)
+        self.assertIsInstance(get_sampler(per_second=10), RateLimitingSampler)
+
+
+class FanTracerCase(TestCase):
+    def setUp(self):
+        self.recorder = InMemoryRecorder()
+        self.discovery = LocalDiscovery()
+        self.discovery.tracer = FanTracer(self.recorder, sampler=ConstSampler(False))
+
+    def test_skip_unsampled(self):
+        with Context(self.discovery) as ctx:
+            with ctx.create_child_context() as child:
+                self.assertFalse(child.span.context.sampled)
+        self.assertEqual(self.recorder.get_spans(), [])
+
+    def test_record_errors(self):
+        with self.assertRaises(ValueError):
+            with Context(self.discovery, name='failed'):
+                raise ValueError()
+        self.assertEqual([s.operation_name for s in self.recorder.get_spans()], ['failed'])
@@ -1,11 +1,18 @@
+import asyncio
+import functools
+import time
 from unittest import TestCase
 
+import pytest
+
 from basictracer import BasicTracer
 from basictracer.recorder import InMemoryRecorder
 
 from fan.context import Context
 from fan.discovery import LocalDiscovery
 from fan.remote import LocalEndpoint
+from fan.exceptions import RPCTimeout
+from fan.rpc import RPC, stubs
 from fan.tests import DummyService, NestedService
 
 
@@ -34,3 +41,68 @@ class ServiceTest(FanTest):
         msg = 'test_message'
         with self.context:
             self.assertEqual(self.context.rpc.nested.tree.dummy.echo(msg), msg)
+
+    def test_03_stub_cache(self):
+        discovery = self.context.discovery
+        with self.context:
+            self.context.rpc.dummy.echo('a')
+            stub = stubs.get(discovery, ('dummy', 'echo'))
+            self.assertEqual(stub.span_name, 'dummy.echo')
+            self.context.rpc.dummy.echo('b')
+            self.assertIs(stubs.get(discovery, ('dummy', 'echo')), stub)
+            # callers are reused within context
+            self.assertIs(self.context.rpc.dummy.echo, self.context.rpc.dummy.echo)
+            # caller has no own names hiding remote methods
+            self.assertEqual(self.context.rpc.dummy.resolve.call_path, ('dummy', 'resolve'))
+
+            replacement = LocalEndpoint(DummyService())
+            discovery.register(replacement)
+            self.assertIsNone(stubs.get(discovery, ('dummy', 'echo')))
+            self.context.rpc.dummy.echo('c')
+            self.assertIs(stubs.get(discovery, ('dummy', 'echo')).endpoint, replacement)
+
+    def test_04_fan_out(self):
+        def fail():
+            raise ValueError('fail')
+
+        with self.context:
+            calls = [functools.partial(self.context.rpc.dummy.echo, i) for i in range(5)]
+            results = self.context.rpc.fan_out(calls + [fail], limit=2)
+        self.assertEqual([r.get() for r in results[:5]], list(range(5)))
+        self.assertIsInstance(results[5].error, ValueError)
+        names = [s.operation_name for s in self.recorder.get_spans()]
+        self.assertEqual(names.count('dummy.echo'), 5)
+
+    def test_05_fan_out_timeout(self):
+        with self.context:
+            results = self.context.rpc.fan_out([lambda: time.sleep(0.2), lambda: 1], timeout=0.05)
+        self.assertIsInstance(results[0].error, RPCTimeout)
+        self.assertEqual(results[1].get(), 1)
+
+
+@pytest.mark.asyncio
+async def test_async_fan_out():
+    running = []
+
+    async def call(delay):
+        running.append(delay)
+        assert len(running) <= 2
+        await asyncio.sleep(delay)
+        running.remove(delay)
+        return delay
+
+    rpc = RPC(None, async_caller=True)
+    results = await rpc.fan_out([functools.partial(call, d) for d in (0.01, 0.02, 0.2)],
+                                limit=2, timeout=0.1)
+    assert [r.ok for r in results] == [True, True, False]
+    assert isinstance(results[2].error, RPCTimeout)
+
+
+@pytest.mark.asyncio
+async def test_async_fan_out_cancel():
+    rpc = RPC(None, async_caller=True)
+    task = asyncio.ensure_future(rpc.fan_out([functools.partial(asyncio.sleep, 1)]))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
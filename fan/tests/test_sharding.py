@@ -0,0 +1,86 @@
+from collections import Counter
+from unittest import TestCase
+
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.context import Context
+from fan.discovery import LocalDiscovery
+from fan.exceptions import RPCException
+from fan.remote import BalancedProxyEndpoint, Transport
+from fan.sharding import HashRing, get_shard
+
+
+class ShardTransport(Transport):
+    def rpc_call(self, method, ctx, *args, **kwargs):
+        return self.params['id']
+
+
+class ShardDiscovery(LocalDiscovery):
+    def get_transport_class(self, name):
+        return ShardTransport
+
+
+class HashRingCase(TestCase):
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        owners = Counter(ring.get(key) for key in range(4000))
+        self.assertEqual(set(owners), {'a', 'b', 'c', 'd'})
+        self.assertTrue(all(count > 600 for count in owners.values()), owners)
+
+    def test_membership_change(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        before = {key: ring.get(key) for key in range(1000)}
+        ring.update(['a', 'b', 'c', 'd', 'e'])
+        moved = [key for key in before if ring.get(key) != before[key]]
+        # only keys taken by the new node move
+        self.assertEqual({ring.get(key) for key in moved}, {'e'})
+        self.assertLess(len(moved), 350)
+        ring.update(['a', 'b', 'c', 'd'])
+        self.assertEqual({key: ring.get(key) for key in before}, before)
+
+    def test_lookup(self):
+        ring = HashRing(['a', 'b', 'c'])
+        nodes = list(ring.lookup('key'))
+        self.assertEqual(sorted(nodes), ['a', 'b', 'c'])
+        self.assertEqual(nodes[0], ring.get('key'))
+        self.assertIsNone(HashRing().get('key'))
+
+    def test_get_shard(self):
+        self.assertEqual(get_shard('user', (), {'user': 5}), 5)
+        self.assertEqual(get_shard(0, ('x',), {}), 'x')
+        self.assertEqual(get_shard('/store/{a}/item/{b}/', (), {'a': 1, 'b': 2}),
+                         '/store/1/item/2/')
+        with self.assertRaises(RPCException):
+            get_shard('user', (), {})
+
+
+class ShardedEndpointCase(TestCase):
+    def setUp(self):
+        self.discovery = ShardDiscovery()
+        self.discovery.tracer = BasicTracer(InMemoryRecorder())
+        methods = [{'name': 'get', 'shard_key': 'user'}, {'name': 'ping'}]
+        self.configs = {'i{}'.format(i): {'transport': 'shard', 'id': i, 'methods': methods}
+                        for i in range(3)}
+        self.endpoint = BalancedProxyEndpoint(self.discovery, 'svc', self.configs)
+
+    def call(self, method, **kwargs):
+        with Context(self.discovery) as ctx:
+            return self.endpoint.perform_call(ctx, method, **kwargs)
+
+    def test_routing(self):
+        owners = {user: self.call('get', user=user) for user in range(30)}
+        self.assertEqual({user: self.call('get', user=user) for user in range(30)}, owners)
+        self.assertEqual(set(owners.values()), {0, 1, 2})
+        # not sharded methods are balanced as usual
+        self.assertEqual([self.call('ping') for _ in range(3)], [0, 1, 2])
+
+    def test_failover(self):
+        owner = self.call('get', user=1)
+        instance = self.endpoint.instance_list[owner]
+        self.assertIs(self.endpoint.choose_instance(shard=1), instance)
+        fallback = self.endpoint.choose_instance([instance], shard=1)
+        self.assertIsNot(fallback, instance)
+        configs = {key: config for key, config in self.configs.items() if config['id'] != owner}
+        self.endpoint.update_instances(configs)
+        self.assertEqual(self.call('get', user=1), fallback.params['id'])
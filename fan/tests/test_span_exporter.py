@@ -0,0 +1,74 @@
+import asyncio
+import time
+from unittest import TestCase
+
+import pytest
+
+from fan.asynchronous import AsyncSpanExporter
+from fan.sync import SpanExporter
+
+
+class CollectExporter(SpanExporter):
+    def __init__(self, *args, **kwargs):
+        super().__init__('zipkin', *args, **kwargs)
+        self.batches = []
+
+    def send(self, batch):
+        self.batches.append(batch)
+        self.exported += len(batch)
+
+
+class SpanExporterCase(TestCase):
+    def test_batch_by_size(self):
+        exporter = CollectExporter(batch_size=3, flush_interval=10)
+        for i in range(7):
+            exporter.export(b'span%d' % i)
+        exporter.stop()
+        self.assertEqual([len(b) for b in exporter.batches], [3, 3, 1])
+        self.assertEqual(exporter.stats['exported'], 7)
+
+    def test_batch_by_time(self):
+        exporter = CollectExporter(batch_size=100, flush_interval=0.01)
+        exporter.export(b'span')
+        time.sleep(0.1)
+        self.assertEqual(exporter.batches, [[b'span']])
+        exporter.stop()
+
+    def test_drop_oldest(self):
+        exporter = CollectExporter(max_queue_size=2, batch_size=10, flush_interval=10)
+        with exporter.cond:
+            for i in range(4):
+                exporter._enqueue(i)
+        self.assertEqual(list(exporter.queue), [2, 3])
+        self.assertEqual(exporter.stats['dropped'], 2)
+
+    def test_drop_newest(self):
+        exporter = CollectExporter(max_queue_size=2, batch_size=10, flush_interval=10,
+                                   policy=SpanExporter.DROP_NEWEST)
+        with exporter.cond:
+            for i in range(4):
+                exporter._enqueue(i)
+        self.assertEqual(list(exporter.queue), [0, 1])
+        self.assertEqual(exporter.stats['dropped'], 2)
+
+
+class AsyncCollectExporter(AsyncSpanExporter):
+    def __init__(self, *args, **kwargs):
+        super().__init__('zipkin', *args, **kwargs)
+        self.batches = []
+
+    async def send(self, batch):
+        self.batches.append(batch)
+        self.exported += len(batch)
+
+
+@pytest.mark.asyncio
+async def test_async_exporter():
+    exporter = AsyncCollectExporter(batch_size=3, flush_interval=10)
+    for i in range(4):
+        exporter.export(b'span%d' % i)
+    await asyncio.sleep(0)
+    assert [len(b) for b in exporter.batches] == [3]
+    await exporter.stop()
+    assert [len(b) for b in exporter.batches] == [3, 1]
+    assert exporter.stats['queued'] == 0
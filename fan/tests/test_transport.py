@@ -1,5 +1,12 @@
+import time
 from unittest import TestCase
-from fan.remote import RemoteEndpoint, Transport
+
+from basictracer import BasicTracer
+from basictracer.recorder import InMemoryRecorder
+
+from fan.context import Context
+from fan.exceptions import DeadlineExceeded
+from fan.remote import BalancedProxyEndpoint, RemoteEndpoint, Transport
 from fan.discovery import SimpleDictDiscovery, CompositeDiscovery, LocalDiscovery
 from fan.service import Service, endpoint
 
@@ -28,6 +35,10 @@ class DummyService(Service):
     def ping(self, ctx):
         return 'pong'
 
+    @endpoint
+    def count(self, ctx, n):
+        yield from range(n)
+
 
 class DummyRemoteEndpoint(RemoteEndpoint):
     transportClass = DummyTransport
@@ -50,3 +61,45 @@ class TransportCase(TestCase):
         r = self.discovery.remote
         assert l.cached_endpoints[('dummy',)] == ep
         assert r.data['dummy'] == {'transport': 'dummy'}
+
+    def test_found_proxy_keeps_stubs(self):
+        self.dict_discovery.data['dummy'] = {'transport': 'dummy'}
+        generation = self.discovery.generation
+        proxy = self.discovery.find_endpoint(('dummy',))
+        self.assertIs(self.discovery.find_endpoint(('dummy',)), proxy)
+        self.assertEqual(self.discovery.generation, generation)
+
+    def test_short_circuit(self):
+        ep = DummyRemoteEndpoint(self.discovery, self.svc, {'transport': 'dummy', 'id': 1})
+        self.discovery.register(ep)
+        # another discovery of the same process finds the config registered by the first one
+        recorder = InMemoryRecorder()
+        discovery = CompositeDiscovery(FanTestLocalDiscovery(), self.dict_discovery)
+        discovery.tracer = BasicTracer(recorder)
+        with Context(discovery) as ctx:
+            self.assertEqual(ctx.rpc.dummy.ping(), 'pong')
+            self.assertEqual(ctx.rpc.dummy.count(2), [0, 1])
+        proxy = discovery.local.cached_endpoints[('dummy',)]
+        self.assertIs(proxy.find_local(), ep)
+        self.assertFalse(proxy.transport.started)
+        self.assertIn('dummy.ping', [span.operation_name for span in recorder.get_spans()])
+        with Context(discovery) as ctx:
+            ctx.deadline = time.time() - 1
+            with self.assertRaises(DeadlineExceeded):
+                proxy.perform_call(ctx, 'ping')
+
+        # only calls routed to the hosted instance skip the transport
+        configs = {'a': {'transport': 'dummy', 'id': 0}, 'b': {'transport': 'dummy', 'id': 1}}
+        balanced = BalancedProxyEndpoint(discovery, 'dummy', configs)
+        results = []
+        for _ in range(2):
+            with Context(discovery) as ctx:
+                try:
+                    results.append(balanced.perform_call(ctx, 'ping'))
+                except NotImplementedError:
+                    results.append('transport')
+        self.assertEqual(sorted(results), ['pong', 'transport'])
+
+        # stopped endpoint isn't served anymore
+        ep.on_stop()
+        self.assertIsNone(proxy.find_local())
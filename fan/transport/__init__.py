@@ -1,14 +1,18 @@
+import asyncio
 import io
 import json
 import logging
+import time
 
 import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 from basictracer.context import SpanContext
 from basictracer.propagator import Propagator
 
-from fan.exceptions import RPCHttpError, AioRPCHttpError
+from fan.exceptions import DeadlineExceeded, RPCHttpError, AioRPCHttpError
 from fan.remote import Transport
+from fan.transport.cache import shared_caches
 
 
 def hex_string(i):
@@ -28,6 +32,20 @@ class HTTPPropagator(Propagator):
         'baggage': ('ot-baggage', json.dumps, json.loads),
         'sampled': ('ot-sampled', json.dumps, json.loads),
     }
+    deadline_header = 'ot-deadline'
+
+    @classmethod
+    def inject_deadline(cls, deadline, carrier):
+        if deadline is not None:
+            carrier[cls.deadline_header] = repr(deadline)
+        return carrier
+
+    @classmethod
+    def extract_deadline(cls, carrier):
+        try:
+            return float(carrier[cls.deadline_header])
+        except (KeyError, TypeError, ValueError):
+            pass
 
     def inject(self, span_context, carrier):
         for k, v in self.mapping.items():
@@ -56,6 +74,7 @@ class DjangoPropagator(HTTPPropagator):
         # 'baggage': 'ot-baggage',
         'sampled': ('HTTP_OT_SAMPLED', json.dumps, json.loads),
     }
+    deadline_header = 'HTTP_OT_DEADLINE'
 
     def extract(self, carrier):
         self.log.debug('Run extract: {}'.format(carrier))
@@ -74,17 +93,75 @@ class DjangoPropagator(HTTPPropagator):
 class HTTPTransport(Transport):
     log = logging.getLogger('HTTPTransport')
 
+    # connection pool settings, each one may be overridden with endpoint params
+    pool_connections = 10  # number of per-host pools to keep
+    pool_maxsize = 10  # keep-alive connections per host
+    pool_block = False  # wait for a free connection instead of opening an extra one
+    pool_idle_timeout = 60  # drop pooled connections after this many idle seconds
+    response_cache_bytes = 10 * 2 ** 20  # default size limit of every method response cache
+
     def __init__(self, discovery, endpoint, params):
         super().__init__(discovery, endpoint, params)
         self.base_url = '{transport}://{host}:{port}'.format(**params)
         self.methods = {}
+        self.caches = {}
         for method in params['methods']:
             self.methods[method['name']] = method
+            if method.get('cache'):
+                # one cache for all instances of the service
+                self.caches[method['name']] = shared_caches.get(
+                    discovery, getattr(endpoint, 'name', None), method,
+                    self.get_param('response_cache_bytes'))
+        self.session = None
+        self.last_used = 0
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.get_param('pool_connections'),
+                              pool_maxsize=self.get_param('pool_maxsize'),
+                              pool_block=self.get_param('pool_block'))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def on_start(self):
+        super().on_start()
+        if self.session is None:
+            self.session = self.create_session()
+
+    def on_stop(self):
+        super().on_stop()
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def evict_idle(self):
+        '''
+        Server usually closes keep-alive connection earlier than we do, so drop pooled
+        connections if they weren't used for a while. Pools are recreated on demand.
+        '''
+        now = time.monotonic()
+        idle_timeout = self.get_param('pool_idle_timeout')
+        if idle_timeout and self.last_used and now - self.last_used > idle_timeout:
+            self.log.debug('Drop idle connections: {}'.format(self.base_url))
+            self.session.close()
+        self.last_used = now
+
+    def cache_lookup(self, method_name, kwargs):
+        """
+        returns (cache, key, entry), entry is None on miss and may need revalidation
+        """
+        cache = self.caches.get(method_name)
+        if cache is None:
+            return None, None, None
+        key = cache.make_key(kwargs)
+        return cache, key, cache.get(key)
 
     def get_headers(self, ctx):
         hdrs = {}
         tracer = ctx.discovery.tracer
         tracer.inject(ctx.span.context, 'http', hdrs)
+        HTTPPropagator.inject_deadline(ctx.deadline, hdrs)
         return hdrs
 
     def prepare_get_params(self, params):
@@ -131,13 +208,32 @@ class HTTPTransport(Transport):
 
     def rpc_call(self, method_name, ctx, **kwargs):
         kw, m, url = self._rpc_call_prepare(kwargs, method_name)
+        cache, key, entry = self.cache_lookup(method_name, kwargs)
+        if entry and entry.fresh:
+            return json.loads(entry.body)
 
-        req = getattr(requests, m)
+        if self.session is None:
+            self.on_start()
+        self.evict_idle()
+        req = getattr(self.session, m)
         self.log.debug('Url: {} Params: {} Func: {}'.format(url, kw, req))
         kw['headers'] = self.get_headers(ctx)
-        resp = req(url, **kw)
-        if resp.status_code in (200, 201):
+        if entry:
+            kw['headers']['If-None-Match'] = entry.etag
+        timeout = ctx.check_deadline()
+        if timeout is not None:
+            kw['timeout'] = timeout
+        try:
+            resp = req(url, **kw)
+        except requests.Timeout as e:
+            raise DeadlineExceeded(url) from e
+        if resp.status_code == 304 and entry:
+            cache.refresh(key)
+            ret = json.loads(entry.body)
+        elif resp.status_code in (200, 201):
             ret = resp.json()
+            if cache and resp.status_code == 200:
+                cache.set(key, resp.content, resp.headers.get('ETag'))
         elif resp.status_code in (204,):
             ret = True
         else:
@@ -147,32 +243,96 @@ class HTTPTransport(Transport):
         return ret
 
 
+def create_client_session(limit=100, limit_per_host=0, keepalive_timeout=15, ttl_dns_cache=10):
+    """
+    Session with own connection pool and dns cache. Should be closed by the owner
+    """
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host,
+                                     keepalive_timeout=keepalive_timeout,
+                                     use_dns_cache=True, ttl_dns_cache=ttl_dns_cache)
+    return aiohttp.ClientSession(connector=connector)
+
+
 class AsyncHTTPTransport(HTTPTransport):
     log = logging.getLogger('AsyncHTTPTransport')
 
+    # connector settings, used only when discovery doesn't share a session
+    limit = 100  # total connections
+    limit_per_host = 0  # 0 means no limit
+    keepalive_timeout = 15
+    ttl_dns_cache = 10
+
+    def __init__(self, discovery, endpoint, params):
+        super().__init__(discovery, endpoint, params)
+        self.own_session = False
+
     def _prepare_multipart_request(self, data):
         return {'data': data}
 
+    def create_session(self):
+        return create_client_session(limit=self.get_param('limit'),
+                                     limit_per_host=self.get_param('limit_per_host'),
+                                     keepalive_timeout=self.get_param('keepalive_timeout'),
+                                     ttl_dns_cache=self.get_param('ttl_dns_cache'))
+
     async def on_start(self):
-        super().on_start()
+        Transport.on_start(self)
+        if self.session is not None:
+            return
+        # prefer session shared by all transports of discovery
+        get_session = getattr(self.discovery, 'get_http_session', None)
+        if get_session:
+            self.session = get_session()
+            self.own_session = False
+        else:
+            self.session = self.create_session()
+            self.own_session = True
 
     async def on_stop(self):
-        super().on_stop()
+        Transport.on_stop(self)
+        if self.session is not None and self.own_session:
+            await self.session.close()
+        self.session = None
 
     async def rpc_call(self, method_name, ctx, **kwargs):
         kw, m, url = self._rpc_call_prepare(kwargs, method_name)
+        cached = self.cache_lookup(method_name, kwargs)
+        entry = cached[2]
+        if entry and entry.fresh:
+            return json.loads(entry.body)
 
-        async with aiohttp.ClientSession() as session:
-            req = getattr(session, m)
-            self.log.debug('Url: {} Params: {} Func: {}'.format(url, kw, req))
-            kw['headers'] = self.get_headers(ctx)
-            async with req(url, **kw) as resp:
-                if resp.status in (200, 201):
-                    ret = await resp.json()
-                elif resp.status in (204, ):
-                    ret = True
-                else:
-                    # TODO: howto return error
-                    self.log.error('Resp: {} : {}'.format(resp.status, resp))
-                    raise AioRPCHttpError(resp.status, await resp.read())
-                return ret
+        if self.session is None or self.session.closed:
+            self.session = None
+            await self.on_start()
+        req = getattr(self.session, m)
+        self.log.debug('Url: {} Params: {} Func: {}'.format(url, kw, req))
+        kw['headers'] = self.get_headers(ctx)
+        if entry:
+            kw['headers']['If-None-Match'] = entry.etag
+        timeout = ctx.check_deadline()
+        if timeout is not None:
+            kw['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        try:
+            return await self.request(req, url, kw, cached)
+        except asyncio.TimeoutError as e:
+            raise DeadlineExceeded(url) from e
+
+    async def request(self, req, url, kw, cached=(None, None, None)):
+        cache, key, entry = cached
+        async with req(url, **kw) as resp:
+            if resp.status == 304 and entry:
+                cache.refresh(key)
+                ret = json.loads(entry.body)
+            elif resp.status == 200 and cache:
+                body = await resp.read()
+                cache.set(key, body, resp.headers.get('ETag'))
+                ret = json.loads(body)
+            elif resp.status in (200, 201):
+                ret = await resp.json()
+            elif resp.status in (204, ):
+                ret = True
+            else:
+                # TODO: howto return error
+                self.log.error('Resp: {} : {}'.format(resp.status, resp))
+                raise AioRPCHttpError(resp.status, await resp.read())
+            return ret
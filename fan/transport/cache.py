@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'expires_at')
+
+    def __init__(self, body, etag, expires_at):
+        self.body = body
+        self.etag = etag
+        self.expires_at = expires_at
+
+    @property
+    def fresh(self):
+        return time.monotonic() < self.expires_at
+
+    @property
+    def size(self):
+        return len(self.body)
+
+
+class ResponseCache:
+    '''
+    LRU of raw response bodies for one method, bounded by entries count and total size in bytes.
+    Expired entries with ETag are kept to revalidate them with If-None-Match
+    '''
+    def __init__(self, ttl=60, max_entries=1000, max_bytes=10 * 2 ** 20, key_fields=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.key_fields = key_fields
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_policy(cls, policy, max_bytes):
+        '''
+        policy is `cache` item of method config: {ttl, max_entries, max_bytes, key_fields}
+        '''
+        policy = dict(policy)
+        policy.setdefault('max_bytes', max_bytes)
+        return cls(**policy)
+
+    @property
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits,
+                'misses': self.misses, 'revalidated': self.revalidated,
+                'evictions': self.evictions}
+
+    def make_key(self, kwargs):
+        if self.key_fields is not None:
+            kwargs = {k: kwargs.get(k) for k in self.key_fields}
+        return json.dumps(kwargs, sort_keys=True, default=str)
+
+    def get(self, key):
+        '''
+        entry, that may be expired, or None
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.fresh:
+                self.hits += 1
+            elif entry.etag is None:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, etag=None):
+        entry = CacheEntry(body, etag, time.monotonic() + self.ttl)
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def refresh(self, key):
+        '''
+        response wasn't modified, entry is fresh again
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.expires_at = time.monotonic() + self.ttl
+                self.revalidated += 1
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.size = 0
+            elif key in self.entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key).size
+
+
+class SharedCaches:
+    '''
+    Response caches per discovery, transports of all instances of a service share
+    the cache of a method while its config is the same
+    '''
+    def __init__(self):
+        self.discoveries = WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get(self, discovery, service_name, method, max_bytes):
+        key = json.dumps([service_name, method], sort_keys=True, default=str)
+        with self.lock:
+            caches = self.discoveries.setdefault(discovery, {})
+            if key not in caches:
+                caches[key] = ResponseCache.from_policy(method['cache'], max_bytes)
+            return caches[key]
+
+
+shared_caches = SharedCaches()
@@ -1,4 +1,11 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+
 _split_object = object()
+_missing = object()
 
 
 def _make_key(args, kwargs):
@@ -11,15 +18,162 @@ def _make_key(args, kwargs):
     return key
 
 
-def async_cache(fun):
-    cache = {}
+class SingleFlight:
+    """
+    Concurrent calls with the same key from different threads share one execution of `factory`
+    """
+    class Flight:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+        def wait(self):
+            self.done.wait()
+            if self.error is not None:
+                raise self.error
+            return self.result
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.flights)
+
+    def __contains__(self, key):
+        return key in self.flights
+
+    def do(self, key, factory):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = self.flights[key] = self.Flight()
+                leader = True
+        if not leader:
+            return flight.wait()
+        try:
+            flight.result = factory()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class AsyncSingleFlight:
+    """
+    Concurrent calls with the same key share one execution of `factory`
+    """
+    def __init__(self):
+        self.flights = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.flights)
+
+    def __contains__(self, key):
+        return key in self.flights
+
+    async def do(self, key, factory):
+        if key in self.flights:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda t: self.flights.pop(key, None))
+            self.flights[key] = task
+        # cancellation of one waiter shouldn't cancel others
+        return await asyncio.shield(self.flights[key])
+
+
+class AsyncCache:
+    """
+    Async results cache: concurrent misses are coalesced into a single call,
+    optionally bounded with LRU eviction and per-entry TTL. Exceptions are not cached
+    """
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key => (value, expires_at)
+        self.single_flight = AsyncSingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.lookup(key) is not _missing
+
+    @property
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'coalesced': self.single_flight.coalesced}
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return _missing
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.entries[key]
+            return _missing
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.entries[key] = (value, None if ttl is None else time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while self.max_size and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key=_missing):
+        """
+        drop one entry or whole cache
+        """
+        if key is _missing:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    async def get(self, key, factory):
+        value = self.lookup(key)
+        if value is not _missing:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        async def load():
+            result = await factory()
+            self.set(key, result)
+            return result
+
+        return await self.single_flight.do(key, load)
+
+
+def async_cache(fun=None, *, max_size=None, ttl=None):
+    """
+    Cache coroutine results by arguments, usable as `@async_cache` or `@async_cache(ttl=10)`.
+    Cache is available as `.cache` attribute of decorated function
+    """
+    if fun is None:
+        return functools.partial(async_cache, max_size=max_size, ttl=ttl)
+    cache = AsyncCache(max_size=max_size, ttl=ttl)
+
+    @functools.wraps(fun)
     async def _inner(*args, **kwargs):
         key = _make_key(args, kwargs)
-        if key not in cache:
-            result = await fun(*args, **kwargs)
-            cache[key] = result
-
-        return cache[key]
+        return await cache.get(key, functools.partial(fun, *args, **kwargs))
 
+    _inner.cache = cache
     return _inner